@@ -9,17 +9,24 @@ urlpatterns = [
     url(r'^attest/$', views.attest_overview, name='admin-attest'),
     url(r'^pay/$', views.pay_overview, name='admin-pay'),
     url(r'^account/$', views.account_overview, name='admin-account'),
+    url(r'^confirm/(?P<kind>expenses)/$', views.confirm_queue, name='admin-confirm-api'),
+    url(r'^attest/(?P<kind>expenses|invoices)/$', views.attest_queue, name='admin-attest-api'),
+    url(r'^pay/(?P<kind>expenses|invoices)/$', views.pay_queue, name='admin-pay-api'),
+    url(r'^account/(?P<kind>expenses|invoices)/$', views.account_queue, name='admin-account-api'),
 
     url(r'^expense/(?P<pk>\d+)/verification/edit/$', views.edit_expense_verification, name='admin-expense-edit-verification'),
     url(r'^expense/(?P<expense_pk>\d+)/verification/$', views.set_verification, name='admin-expense-verification'),
     url(r'^expense/(?P<pk>\d+)/confirm/$', views.confirm_expense, name='admin-expense-confirm'),
     url(r'^expense/(?P<pk>\d+)/unconfirm/$', views.unconfirm_expense, name='admin-expense-unconfirm'),
+    url(r'^expenses/confirm/$', views.confirm_expenses, name='admin-expenses-confirm'),
+    url(r'^expenses/unconfirm/$', views.unconfirm_expenses, name='admin-expenses-unconfirm'),
 
     url(r'^invoice/(?P<invoice_pk>\d+)/verification/$', views.invoice_set_verification, name='admin-invoice-verification'),
 
     url(r'^expense-part/(?P<pk>\d+)/attest/$', views.attest_expense_part, name='admin-expensepart-attest'),
     url(r'^expense-part/(?P<pk>\d+)/unattest/$', views.unattest_expense, name='admin-expense-unattest'),
     url(r'^invoice-part/(?P<pk>\d+)/attest/$', views.attest_invoice_part, name='admin-invoicepart-attest'),
+    url(r'^parts/attest/$', views.attest_parts, name='admin-parts-attest'),
 
     url(r'^expenses/$', views.expense_overview, name='admin-expense-overview'),
     url(r'^invoices/$', views.invoice_overview, name='admin-invoice-overview'),
@@ -27,5 +34,10 @@ urlpatterns = [
     url(r'^verifications/$', views.search_verification, name='admin-search-verification'),
     url(r'^verifications/search/$', views.search_verification_response, name='admin-search-verification-api'),
     url(r'^verifications/list$', views.list_verification, name='admin-list-verification'),
+    url(r'^verifications/import/$', views.import_verifications, name='admin-verifications-import'),
+    url(r'^verifications/sie/$', views.sie_export, name='admin-sie-export'),
+    url(r'^search/$', views.search, name='admin-search'),
+    url(r'^search/results/$', views.search_response, name='admin-search-api'),
     url(r'^users/$', views.user_overview, name='admin-user-overview'),
+    url(r'^metrics/$', views.metrics, name='admin-metrics'),
 ]
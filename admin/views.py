@@ -1,21 +1,67 @@
+import codecs
+import csv
+import hashlib
 import json
-from datetime import date, datetime
+from datetime import date, datetime, timedelta, timezone
 from decimal import *
 
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required, user_passes_test
-from django.core.exceptions import ObjectDoesNotExist
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.core.cache import cache
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
-from django.db.models.functions import Length
-from django.http import HttpResponseForbidden, HttpResponseRedirect, HttpResponseBadRequest, JsonResponse, Http404
+from django.db import transaction
+from django.db.models import Count, Q
+from django.http import HttpResponseForbidden, HttpResponseRedirect, HttpResponseBadRequest, JsonResponse, Http404, \
+    StreamingHttpResponse
 from django.shortcuts import render
 from django.urls import reverse
-from django.views.decorators.http import require_http_methods, require_GET, require_POST
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition, require_http_methods, require_GET, require_POST
 
 from cashflow import dauth
-from expenses.models import Expense, ExpensePart, BankAccount, Comment, Profile
+from cashflow import metrics as cashflow_metrics
+from cashflow import pagination
+from expenses import queues, sie
+from expenses.models import Expense, ExpensePart, BankAccount, Comment, Profile, split_verification, \
+    verification_year
 from invoices.models import Invoice, InvoicePart
 
+# Number of results per page from search_response
+SEARCH_PAGE_SIZE = 25
+
+# Number of rows per page from the queue endpoints
+QUEUE_PAGE_SIZE = 50
+
+
+def queue_etag(name):
+    """
+    Returns an etag function for condition() that changes when the named queue, or the user's permissions, change.
+    Filtering on min_age makes the rows depend on the date too, so then it also changes every day.
+    Only the cache is read, never the expense tables.
+    """
+    def etag(request, *args, **kwargs):
+        profile = request.user.profile
+        scope = [request.user.pk, sorted(profile.may_view_attest()), sorted(profile.may_view_account())]
+        if request.GET.get('min_age'):
+            scope.append(date.today().isoformat())
+        return str(queues.version(name)) + '-' + hashlib.md5(json.dumps(scope).encode()).hexdigest()
+    return etag
+
+
+def queue_last_modified(name):
+    """
+    Returns a last modified function for condition() that returns when the named queue last changed, or when the day
+    began if that is later and the queue is filtered on min_age.
+    """
+    def last_modified(request, *args, **kwargs):
+        modified = datetime.fromtimestamp(queues.version(name) / 1000, timezone.utc)
+        if request.GET.get('min_age'):
+            modified = max(modified, datetime.combine(date.today(), datetime.min.time()).astimezone(timezone.utc))
+        return modified
+    return last_modified
+
 
 @require_GET
 @login_required
@@ -32,16 +78,28 @@ def index(request):
 @user_passes_test(lambda u: u.profile.may_view_attest())
 def attest_overview(request):
     """
-    Displays the attest overview list.
+    Displays the attest overview list. The expenses and invoices are loaded from attest_queue.
     """
-    return render(request, 'admin/attest/overview.html', {
-        'expenses': json.dumps(
-            [expense.to_dict() for expense in Expense.view_attestable(request.user.profile.may_view_attest(), request.user)],
-            default=json_serial),
-        'invoices': json.dumps(
-            [invoice.to_dict() for invoice in Invoice.view_attestable(request.user.profile.may_view_attest(), request.user)],
-            default=json_serial)
-    })
+    return render(request, 'admin/attest/overview.html')
+
+
+@require_GET
+@login_required
+@user_passes_test(lambda u: u.profile.may_view_attest())
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=queue_etag('attest'), last_modified_func=queue_last_modified('attest'))
+def attest_queue(request, kind):
+    """
+    Returns a page of the expenses or invoices that the user may attest, newest first.
+    """
+    if kind == 'expenses':
+        return queue_response(
+            request, Expense, Expense.view_attestable(request.user.profile.may_view_attest(), request.user), ['-id']
+        )
+    return queue_response(
+        request, Invoice, Invoice.view_attestable(request.user.profile.may_view_attest(), request.user),
+        ['-due_date', '-id']
+    )
 
 
 @require_POST
@@ -112,18 +170,91 @@ def attest_invoice_part(request, pk):
     return HttpResponseRedirect(reverse('invoices-show', kwargs={'pk': invoice_part.invoice.id}))
 
 
+@require_POST
+@login_required
+@user_passes_test(lambda u: u.profile.may_attest())
+def attest_parts(request):
+    """
+    Attests the expense parts in expense_part and the invoice parts in invoice_part in one transaction.
+    Returns the ids of the attested parts and an error for each part that could not be attested.
+    """
+    try:
+        expense_part_ids = list(dict.fromkeys(int(pk) for pk in request.POST.getlist('expense_part')))
+        invoice_part_ids = list(dict.fromkeys(int(pk) for pk in request.POST.getlist('invoice_part')))
+    except ValueError:
+        return HttpResponseBadRequest("Ogiltigt id")
+
+    permissions = request.user.profile.permissions()
+    errors = []
+    with transaction.atomic():
+        expense_parts = ExpensePart.objects.select_related('expense__owner__user').select_for_update() \
+            .in_bulk(expense_part_ids)
+        attest_expense_parts = []
+        for pk in expense_part_ids:
+            part = expense_parts.get(pk)
+            if part is None:
+                error = 'Kvittodelen finns inte'
+            elif part.attested_by_id is not None:
+                error = 'Kvittodelen är redan attesterad'
+            elif not permissions.may_attest(part.cost_centre):
+                error = 'Du får inte attestera denna kvittodel'
+            elif part.expense.owner.user_id == request.user.id:
+                error = 'Du kan inte attestera dina egna kvitton'
+            else:
+                attest_expense_parts.append(part)
+                continue
+            errors.append({'expense_part': pk, 'error': error})
+
+        invoice_parts = InvoicePart.objects.select_related('invoice__owner__user').select_for_update() \
+            .in_bulk(invoice_part_ids)
+        attest_invoice_parts = []
+        for pk in invoice_part_ids:
+            part = invoice_parts.get(pk)
+            if part is None:
+                error = 'Fakturadelen finns inte'
+            elif part.attested_by_id is not None:
+                error = 'Fakturadelen är redan attesterad'
+            elif not permissions.may_attest(part.cost_centre):
+                error = 'Du får inte attestera denna fakturadel'
+            else:
+                attest_invoice_parts.append(part)
+                continue
+            errors.append({'invoice_part': pk, 'error': error})
+
+        comments = []
+        if attest_expense_parts:
+            comments += ExpensePart.bulk_attest(attest_expense_parts, request.user)
+        if attest_invoice_parts:
+            comments += InvoicePart.bulk_attest(attest_invoice_parts, request.user)
+        Comment.bulk_create_and_notify(comments)
+
+    return JsonResponse({
+        'expense_parts': [part.id for part in attest_expense_parts],
+        'invoice_parts': [part.id for part in attest_invoice_parts],
+        'errors': errors,
+    })
+
+
 @require_GET
 @login_required
 @user_passes_test(lambda u: u.profile.may_view_confirm())
 def confirm_overview(request):
     """
-    Shows a list of confirmable receipts and lets user confirm them.
+    Shows a list of confirmable receipts and lets user confirm them. The receipts are loaded from confirm_queue.
     """
-    return render(request, 'admin/confirm/overview.html', {
-        'confirmable_expenses': json.dumps(
-            [expense.to_dict() for expense in Expense.objects.filter(confirmed_by=None).order_by('id').distinct()],
-            default=json_serial)
-    })
+    return render(request, 'admin/confirm/overview.html')
+
+
+@require_GET
+@login_required
+@user_passes_test(lambda u: u.profile.may_view_confirm())
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=queue_etag('confirm'), last_modified_func=queue_last_modified('confirm'))
+def confirm_queue(request, kind):
+    """
+    Returns a page of the expenses that are not confirmed, oldest first.
+    """
+    return queue_response(request, Expense, Expense.confirmable(), ['id'])
 
 
 @require_GET
@@ -131,15 +262,27 @@ def confirm_overview(request):
 @user_passes_test(lambda u: u.profile.may_view_pay())
 def pay_overview(request):
     """
-    Shows a list of all payable expenses and lets user pay them.
+    Shows a list of all payable expenses and lets user pay them. The expenses and invoices are loaded from pay_queue.
     """
     return render(request, 'admin/pay/overview.html', {
-        'invoices': json.dumps([invoice.to_dict() for invoice in Invoice.payable()], default=json_serial),
-        'expenses': json.dumps([expense.to_dict() for expense in Expense.payable()], default=json_serial),
         'accounts': json.dumps([s.name for s in BankAccount.objects.all().order_by('name')])
     })
 
 
+@require_GET
+@login_required
+@user_passes_test(lambda u: u.profile.may_view_pay())
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=queue_etag('pay'), last_modified_func=queue_last_modified('pay'))
+def pay_queue(request, kind):
+    """
+    Returns a page of the payable expenses, grouped by owner, or invoices, by due date.
+    """
+    if kind == 'expenses':
+        return queue_response(request, Expense, Expense.payable(), ['owner_username', 'id'])
+    return queue_response(request, Invoice, Invoice.payable(), ['due_date', 'id'])
+
+
 @require_POST
 @login_required
 @user_passes_test(lambda u: u.profile.may_pay())
@@ -161,14 +304,65 @@ def invoice_pay(request, pk):
 @login_required
 @user_passes_test(lambda u: u.profile.may_view_account())
 def account_overview(request):
-    return render(request, 'admin/account/overview.html', {
-        'expenses': json.dumps(
-            [expense.to_dict() for expense in Expense.view_accountable(request.user.profile.may_view_account())],
-            default=json_serial),
-        'invoices': json.dumps(
-            [invoice.to_dict() for invoice in Invoice.view_accountable(request.user.profile.may_view_account())],
-            default=json_serial)
-    })
+    """
+    Shows a list of the expenses and invoices the user may account. They are loaded from account_queue.
+    """
+    return render(request, 'admin/account/overview.html')
+
+
+@require_GET
+@login_required
+@user_passes_test(lambda u: u.profile.may_view_account())
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=queue_etag('account'), last_modified_func=queue_last_modified('account'))
+def account_queue(request, kind):
+    """
+    Returns a page of the expenses, by expense date, or invoices that the user may account.
+    """
+    if kind == 'expenses':
+        return queue_response(
+            request, Expense, Expense.view_accountable(request.user.profile.may_view_account()), ['expense_date', 'id']
+        )
+    return queue_response(request, Invoice, Invoice.view_accountable(request.user.profile.may_view_account()), ['id'])
+
+
+def queue_response(request, model, queryset, ordering):
+    """
+    Returns a page of the expenses or invoices in queryset as lightweight rows sorted by ordering.
+    The queue can be filtered on cost_centre, owner (username) and min_age (days since the row was created).
+    The first page also lists the cost centres in the queue, before the cost_centre filter, with the number of rows
+    in each.
+    """
+    parts, parent = (ExpensePart, 'expense') if model is Expense else (InvoicePart, 'invoice')
+
+    if request.GET.get('owner'):
+        queryset = queryset.filter(owner__user__username=request.GET['owner'])
+    if request.GET.get('min_age'):
+        try:
+            min_age = int(request.GET['min_age'])
+        except ValueError:
+            return HttpResponseBadRequest("min_age måste vara ett heltal")
+        queryset = queryset.filter(created_date__lte=date.today() - timedelta(days=min_age))
+
+    cost_centres = None
+    if not request.GET.get('cursor'):
+        cost_centres = list(parts.objects.filter(**{parent + '__in': queryset.order_by().values('pk')})
+                            .values('cost_centre').annotate(count=Count(parent, distinct=True)).order_by('cost_centre'))
+    if request.GET.get('cost_centre'):
+        queryset = queryset.filter(pk__in=parts.objects.filter(cost_centre=request.GET['cost_centre']).values(parent))
+
+    try:
+        page = pagination.paginate_keyset(
+            model.queue_rows(queryset), ordering, request.GET.get('cursor'), QUEUE_PAGE_SIZE
+        )
+    except (ValueError, ValidationError):
+        return HttpResponseBadRequest("Ogiltig cursor")
+
+    return JsonResponse({
+        'results': model.add_parts(page.items),
+        'next': page.next_cursor,
+        'cost_centres': cost_centres,
+    }, json_dumps_params={'default': json_serial})
 
 
 @require_http_methods(["GET", "POST"])
@@ -251,6 +445,74 @@ def unconfirm_expense(request, pk):
         raise Http404("Utlägget finns inte")
 
 
+@require_POST
+@login_required
+def confirm_expenses(request):
+    """
+    Confirms the expenses in expense in one transaction.
+    Returns the ids of the confirmed expenses and an error for each expense that could not be confirmed.
+    """
+    if not request.user.profile.may_confirm():
+        return HttpResponseForbidden("Du har inte rättigheterna för att bekräfta kvittons giltighet")
+    try:
+        expense_ids = list(dict.fromkeys(int(pk) for pk in request.POST.getlist('expense')))
+    except ValueError:
+        return HttpResponseBadRequest("Ogiltigt id")
+
+    errors = []
+    with transaction.atomic():
+        expenses = Expense.objects.select_related('owner__user').select_for_update().in_bulk(expense_ids)
+        confirm = []
+        for pk in expense_ids:
+            expense = expenses.get(pk)
+            if expense is None:
+                errors.append({'expense': pk, 'error': 'Utlägget finns inte'})
+            elif expense.confirmed_by_id is not None:
+                errors.append({'expense': pk, 'error': 'Utlägget är redan bekräftat'})
+            else:
+                confirm.append(expense)
+
+        if confirm:
+            Comment.bulk_create_and_notify(Expense.bulk_confirm(confirm, request.user))
+
+    return JsonResponse({'expenses': [expense.id for expense in confirm], 'errors': errors})
+
+
+@require_POST
+@login_required
+def unconfirm_expenses(request):
+    """
+    Removes the confirmation of the expenses in expense in one transaction.
+    Returns the ids of the unconfirmed expenses and an error for each expense that could not be unconfirmed.
+    """
+    if not request.user.profile.may_unconfirm():
+        return HttpResponseForbidden("Du har inte rättigheterna för att ta bort bekräftelse av kvittons giltighet")
+    try:
+        expense_ids = list(dict.fromkeys(int(pk) for pk in request.POST.getlist('expense')))
+    except ValueError:
+        return HttpResponseBadRequest("Ogiltigt id")
+
+    errors = []
+    with transaction.atomic():
+        expenses = Expense.objects.select_related('owner__user').select_for_update().in_bulk(expense_ids)
+        unconfirm = []
+        for pk in expense_ids:
+            expense = expenses.get(pk)
+            if expense is None:
+                errors.append({'expense': pk, 'error': 'Utlägget finns inte'})
+            elif expense.confirmed_by_id is None:
+                errors.append({'expense': pk, 'error': 'Utlägget är inte bekräftat'})
+            elif expense.reimbursement_id is not None:
+                errors.append({'expense': pk, 'error': 'Utlägget har redan betalats ut'})
+            else:
+                unconfirm.append(expense)
+
+        if unconfirm:
+            Comment.bulk_create_and_notify(Expense.bulk_unconfirm(unconfirm, request.user))
+
+    return JsonResponse({'expenses': [expense.id for expense in unconfirm], 'errors': errors})
+
+
 @require_POST
 @login_required
 @user_passes_test(lambda u: u.profile.may_account())
@@ -305,32 +567,176 @@ def invoice_set_verification(request, invoice_pk):
     return HttpResponseRedirect(reverse('admin-account'))
 
 
+def verification_rows(request):
+    """
+    Returns the rows of a verification import as a list of (kind, id, verification), where kind is 'expense' or
+    'invoice'. The rows are read from a JSON body {"verifications": [{"expense": 1, "verification": "E1"}, ...]} or
+    from a CSV file in file with the columns Typ (Utlägg or Faktura), ID and Verifikat. Rows with an unknown kind or
+    an invalid id get kind None.
+    """
+    if request.content_type == 'application/json':
+        rows = [
+            ('expense', row['expense'], row['verification']) if 'expense' in row else
+            ('invoice', row['invoice'], row['verification']) if 'invoice' in row else
+            (None, None, row.get('verification', ''))
+            for row in json.loads(request.body.decode('utf-8'))['verifications']
+        ]
+    else:
+        lines = codecs.iterdecode(request.FILES['file'], 'utf-8-sig')
+        header = next(lines, '')
+        delimiter = ';' if header.count(';') > header.count(',') else ','
+        fields = next(csv.reader([header], delimiter=delimiter), [])
+        kinds = {'utlägg': 'expense', 'faktura': 'invoice'}
+        # Short rows have None in the columns they lack, and get kind None
+        rows = [
+            (kinds.get((row['Typ'] or '').strip().lower()), row['ID'], row['Verifikat'] or '')
+            for row in csv.DictReader(lines, fieldnames=fields, delimiter=delimiter)
+        ]
+
+    result = []
+    for kind, pk, verification in rows:
+        try:
+            result.append((kind, int(pk), str(verification).strip()))
+        except (TypeError, ValueError):
+            result.append((None, None, str(verification).strip()))
+    return result
+
+
+# Returns the series, accounting year and sequence number that the verification gets on the expense or invoice item,
+# or None if it has no sequence number. Expenses are accounted in the year of their date and invoices when paid.
+def verification_key(kind, item, verification):
+    series, number = split_verification(verification)
+    year = verification_year(number, item.expense_date if kind == 'expense' else item.payed_at)
+    if year is None:
+        return None
+    return series, year, number
+
+
+# Returns {verification key: {(kind, id), ...}} of the expenses and invoices that already have the keys
+def verification_holders(keys):
+    numbers = {}
+    for series, year, number in keys:
+        numbers.setdefault((series, year), set()).add(number)
+    holders = {}
+    for (series, year), sequence in numbers.items():
+        for kind, model in (('expense', Expense), ('invoice', Invoice)):
+            for pk, number in model.verification_sequence(series, year).filter(verification_number__in=sequence) \
+                    .values_list('pk', 'verification_number'):
+                holders.setdefault((series, year, number), set()).add((kind, pk))
+    return holders
+
+
+@require_POST
+@login_required
+@user_passes_test(lambda u: u.profile.may_account())
+def import_verifications(request):
+    """
+    Sets the verification numbers of many expenses and invoices in one transaction, see verification_rows.
+    Returns the ids of the accounted expenses and invoices and an error for each row that could not be imported,
+    numbered from 1. A verification number can only be used once in its series and year, by the rows or by other
+    expenses and invoices.
+    """
+    try:
+        rows = verification_rows(request)
+    except (KeyError, TypeError, AttributeError, ValueError, csv.Error):
+        return HttpResponseBadRequest("Filen kunde inte läsas")
+
+    permissions = request.user.profile.permissions()
+    ids = {'expense': set(), 'invoice': set()}
+    for kind, pk, _ in rows:
+        if kind is not None:
+            ids[kind].add(pk)
+
+    errors = []
+    with transaction.atomic():
+        items = {
+            'expense': Expense.objects.select_related('owner__user').select_for_update().in_bulk(ids['expense']),
+            'invoice': Invoice.objects.select_related('owner__user').select_for_update().in_bulk(ids['invoice']),
+        }
+        cost_centres = {('expense', pk): set() for pk in ids['expense']}
+        cost_centres.update({('invoice', pk): set() for pk in ids['invoice']})
+        for pk, cost_centre in ExpensePart.objects.filter(expense_id__in=ids['expense']) \
+                .values_list('expense_id', 'cost_centre'):
+            cost_centres[('expense', pk)].add(cost_centre)
+        for pk, cost_centre in InvoicePart.objects.filter(invoice_id__in=ids['invoice']) \
+                .values_list('invoice_id', 'cost_centre'):
+            cost_centres[('invoice', pk)].add(cost_centre)
+
+        keys = [
+            verification_key(kind, items[kind][pk], verification) if kind is not None and pk in items[kind] else None
+            for kind, pk, verification in rows
+        ]
+        holders = verification_holders({key for key in keys if key is not None})
+
+        accounted = {'expense': [], 'invoice': []}
+        seen = set()
+        used = {}
+        for number, ((kind, pk, verification), key) in enumerate(zip(rows, keys), 1):
+            item = items[kind].get(pk) if kind is not None else None
+            if kind is None:
+                error = 'Raden saknar giltig typ eller id'
+            elif item is None:
+                error = 'Utlägget finns inte' if kind == 'expense' else 'Fakturan finns inte'
+            elif (kind, pk) in seen:
+                error = 'Finns redan på en annan rad'
+            elif not verification or len(verification) > 7:
+                error = 'Ogiltigt verifikationsnummer'
+            elif not permissions.account_all and \
+                    not any(permissions.may_account(cost_centre) for cost_centre in cost_centres[(kind, pk)]):
+                error = 'Du har inte rättigheter att bokföra det här'
+            elif (item.reimbursement_id if kind == 'expense' else item.payed_by_id) is None:
+                error = 'Du kan inte bokföra det här än'
+            elif key in used:
+                error = 'Verifikationsnumret finns redan på rad ' + str(used[key])
+            elif holders.get(key, set()) - {(kind, pk)}:
+                holder_kind, holder = min(holders[key] - {(kind, pk)})
+                error = 'Verifikationsnumret används redan av ' + \
+                        ('utlägg ' if holder_kind == 'expense' else 'faktura ') + str(holder)
+            else:
+                if key is not None:
+                    used[key] = number
+                seen.add((kind, pk))
+                accounted[kind].append((item, verification))
+                continue
+            errors.append({'row': number, kind or 'id': pk, 'error': error})
+
+        comments = []
+        if accounted['expense']:
+            comments += Expense.bulk_set_verification(accounted['expense'], request.user)
+        if accounted['invoice']:
+            comments += Invoice.bulk_set_verification(accounted['invoice'], request.user)
+        Comment.bulk_create_and_notify(comments)
+
+    return JsonResponse({
+        'expenses': [expense.id for expense, _ in accounted['expense']],
+        'invoices': [invoice.id for invoice, _ in accounted['invoice']],
+        'errors': errors,
+    })
+
+
 @require_GET
 @login_required
 @user_passes_test(lambda u: u.profile.is_admin())
 def expense_overview(request):
     """
-    Lists all expenses.
+    Lists all expenses, newest first, a page at a time.
     """
     cost_centre = request.GET.get('cost_centre')
-    expenses_list = Expense.objects.order_by('-id', '-expense_date').distinct()
+    expenses_list = Expense.objects.all()
     if cost_centre is not None and cost_centre != '':
-        expenses_list = expenses_list.filter(expensepart__cost_centre=cost_centre)
-    expenses_list = expenses_list.all()
-    paginator = Paginator(expenses_list, 25)
-    page = request.GET.get('page')
+        expenses_list = expenses_list.filter(pk__in=ExpensePart.objects.filter(cost_centre=cost_centre).values('expense'))
 
     try:
-        expenses = paginator.page(page)
-    except PageNotAnInteger:
-        expenses = paginator.page(1)
-    except EmptyPage:
-        expenses = paginator.page(paginator.num_pages)
+        expenses = pagination.paginate(
+            Expense.with_related(expenses_list), request.GET.get('cursor'), 25,
+            count_key='expenses:' + (cost_centre or '')
+        )
+    except ValueError:
+        return HttpResponseBadRequest("Ogiltig cursor")
 
     return render(request, 'admin/expenses/overview.html', {
         'expenses': expenses,
-        'cost_centres': json.dumps(
-            [x['cost_centre'] for x in ExpensePart.objects.values('cost_centre').distinct()]),
+        'cost_centres': json.dumps(cost_centre_choices()),
         'cost_centre': cost_centre if cost_centre is not None else ''
     })
 
@@ -340,17 +746,14 @@ def expense_overview(request):
 @user_passes_test(lambda u: u.profile.is_admin())
 def user_overview(request):
     """
-    Lists all users.
+    Lists all users, newest first, a page at a time.
     """
-    paginator = Paginator(Profile.objects.order_by('-id').all(), 25)
-    page = request.GET.get('page')
-
     try:
-        users = paginator.page(page)
-    except PageNotAnInteger:
-        users = paginator.page(1)
-    except EmptyPage:
-        users = paginator.page(paginator.num_pages)
+        users = pagination.paginate(
+            Profile.objects.select_related('user'), request.GET.get('cursor'), 25, count_key='users'
+        )
+    except ValueError:
+        return HttpResponseBadRequest("Ogiltig cursor")
 
     return render(request, 'admin/users/overview.html', {
         'users': users
@@ -362,31 +765,39 @@ def user_overview(request):
 @user_passes_test(lambda u: u.profile.is_admin())
 def invoice_overview(request):
     """
-    Lists all invoices.
+    Lists all invoices, newest first, a page at a time.
     """
     cost_centre = request.GET.get('cost_centre')
-    invoices_list = Invoice.objects.order_by('-id').distinct()
+    invoices_list = Invoice.objects.all()
     if cost_centre is not None and cost_centre != '':
-        invoices_list = invoices_list.filter(invoicepart__cost_centre=cost_centre)
-    invoices_list = invoices_list.all()
-    paginator = Paginator(invoices_list, 25)
-    page = request.GET.get('page')
+        invoices_list = invoices_list.filter(pk__in=InvoicePart.objects.filter(cost_centre=cost_centre).values('invoice'))
 
     try:
-        invoices = paginator.page(page)
-    except PageNotAnInteger:
-        invoices = paginator.page(1)
-    except EmptyPage:
-        invoices = paginator.page(paginator.num_pages)
+        invoices = pagination.paginate(
+            Invoice.with_related(invoices_list), request.GET.get('cursor'), 25,
+            count_key='invoices:' + (cost_centre or '')
+        )
+    except ValueError:
+        return HttpResponseBadRequest("Ogiltig cursor")
 
     return render(request, 'admin/invoices/overview.html', {
         'invoices': invoices,
-        'cost_centres': json.dumps(
-            [x['cost_centre'] for x in ExpensePart.objects.values('cost_centre').distinct()]),
+        'cost_centres': json.dumps(cost_centre_choices()),
         'cost_centre': cost_centre if cost_centre is not None else ''
     })
 
 
+def cost_centre_choices():
+    """
+    Returns the names of all cost centres that have been used, for filtering the lists.
+    """
+    return cache.get_or_set(
+        'cost-centre-choices',
+        lambda: [x['cost_centre'] for x in ExpensePart.objects.order_by().values('cost_centre').distinct()],
+        settings.PAGINATION_COUNT_TTL
+    )
+
+
 @require_GET
 @login_required
 @user_passes_test(lambda u: u.profile.is_admin())
@@ -398,14 +809,70 @@ def search_verification(request):
 @login_required
 @user_passes_test(lambda u: u.profile.is_admin())
 def search_verification_response(request):
-    if len(request.POST['query']) < 1:
+    query = request.POST['query'].strip()
+    if len(query) < 1:
         return JsonResponse({'invoices': [], 'expenses': []})
 
-    invoices = Invoice.objects.filter(verification__contains=request.POST['query']).all()
-    expenses = Expense.objects.filter(verification__contains=request.POST['query']).all()
+    # Only what the search result list shows
+    fields = ('id', 'verification', 'description')
     return JsonResponse({
-        'invoices': [invoice.to_dict() for invoice in invoices[:10]],
-        'expenses': [expense.to_dict() for expense in expenses[:10]]
+        'invoices': list(Invoice.search_verification(query).values(*fields)[:10]),
+        'expenses': list(Expense.search_verification(query).values(*fields)[:10])
+    })
+
+
+@require_GET
+@login_required
+@user_passes_test(lambda u: u.profile.is_admin())
+def search(request):
+    return render(request, 'admin/search.html')
+
+
+@require_GET
+@login_required
+@user_passes_test(lambda u: u.profile.is_admin())
+def search_response(request):
+    """
+    Returns a page of the expenses or invoices whose description or comments match q, best match first.
+    The next page is read with the cursor in the response.
+    """
+    query = request.GET.get('q', '').strip()
+    kind = request.GET.get('type', 'expenses')
+    if kind not in ('expenses', 'invoices'):
+        return HttpResponseBadRequest("type måste vara expenses eller invoices")
+    if len(query) < 1:
+        return JsonResponse({'results': [], 'next': None})
+
+    model, date_field = (Expense, 'expense_date') if kind == 'expenses' else (Invoice, 'invoice_date')
+    results = model.search(query)
+    if request.GET.get('cursor'):
+        try:
+            score, pk = [int(value) for value in pagination.decode_cursor(request.GET['cursor'], 2)]
+        except (TypeError, ValueError):
+            return HttpResponseBadRequest("Ogiltig cursor")
+        results = results.filter(Q(score__lt=score) | Q(score=score, id__lt=pk))
+
+    rows = list(results.values(
+        'id', 'description', 'verification', 'total', 'state', 'score', date_field,
+        'owner__user__first_name', 'owner__user__last_name',
+    )[:SEARCH_PAGE_SIZE + 1])
+    next_cursor = None
+    if len(rows) > SEARCH_PAGE_SIZE:
+        rows = rows[:SEARCH_PAGE_SIZE]
+        next_cursor = pagination.encode_cursor(rows[-1]['score'], rows[-1]['id'])
+
+    states = dict(model.STATES)
+    return JsonResponse({
+        'results': [{
+            'id': row['id'],
+            'description': row['description'],
+            'verification': row['verification'],
+            'amount': row['total'],
+            'date': row[date_field],
+            'status': states[row['state']],
+            'owner': row['owner__user__first_name'] + ' ' + row['owner__user__last_name'],
+        } for row in rows],
+        'next': next_cursor,
     })
 
 
@@ -417,13 +884,9 @@ def list_verification(request):
     year = request.GET.get('year')
 
     year = year if year is not None and year != '' else datetime.now().year
+    series = request.GET.get('series', 'E').upper()
 
-    verification_list = Expense.objects \
-        .filter(expense_date__year=year, verification__regex=r'E') \
-        .order_by(Length('verification').asc(), 'verification') \
-        .all()
-
-    paginator = Paginator(verification_list, 25)
+    paginator = Paginator(Expense.verification_sequence(series, year), 25)
     page = request.GET.get('page')
 
     try:
@@ -437,9 +900,41 @@ def list_verification(request):
         'expenses': verifications,
         'years': years,
         'year': year,
+        'series': series,
+        'gaps': Expense.verification_gaps(series, year),
+        'next_number': Expense.next_verification_number(series, year),
     })
 
 
+@require_GET
+@login_required
+@user_passes_test(lambda u: u.profile.is_admin())
+def sie_export(request):
+    """
+    Streams the SIE4 file with the reimbursed expenses and paid invoices of year.
+    """
+    try:
+        year = int(request.GET.get('year', datetime.now().year))
+    except ValueError:
+        return HttpResponseBadRequest("Ogiltigt år")
+
+    response = StreamingHttpResponse(sie.export(year), content_type='text/plain; charset=' + sie.ENCODING)
+    response['Content-Disposition'] = 'attachment; filename="cashflow-' + str(year) + '.se"'
+    return response
+
+
+@require_GET
+@login_required
+@user_passes_test(lambda u: u.profile.is_admin())
+def metrics(request):
+    """
+    Shows the metrics collected by the worker process that handles the request.
+    """
+    snapshot = cashflow_metrics.snapshot()
+    snapshot['pls_circuit_open'] = dauth.pls_circuit_open()
+    return JsonResponse(snapshot)
+
+
 class FakeFloat(float):
     # noinspection PyMissingConstructor
     def __init__(self, value):
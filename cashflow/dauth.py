@@ -1,12 +1,22 @@
 import json
 import re
+import threading
+import time
 import urllib.parse
+from collections import namedtuple
 
 import requests
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_in, user_logged_out
+from django.core.cache import cache
+from django.db import connection
+from django.dispatch import receiver
 from django.http import HttpResponseRedirect
 
+from cashflow import metrics
+from cashflow import outbound
+
 
 class DAuth(object):
     """
@@ -21,7 +31,12 @@ class DAuth(object):
         """
         url = settings.LOGIN_API_URL + '/verify/' + str(token) + '.json?api_key=' + settings.LOGIN_API_KEY
 
-        req = requests.get(url)
+        try:
+            req = outbound.get('login', url)
+        except requests.RequestException as e:
+            print("Could not reach login:", e)
+            return None
+
         if req.status_code == 200:
             data = req.json()
 
@@ -50,20 +65,217 @@ class DAuth(object):
             return None
 
 
+PLS_FAILURES_KEY = 'pls-circuit-failures'
+PLS_CIRCUIT_OPEN_KEY = 'pls-circuit-open'
+
+
 def get_permissions(user):
     """
     Get permissions for user through the pls API.
+
+    Responses are cached in the shared cache and are fresh for PLS_CACHE_TTL seconds.
+    After that they are served stale for up to PLS_STALE_TTL seconds while pls is
+    asked again in the background, so a slow or unavailable pls does not block requests.
     """
 
     # Jag bryr mig inte om regler och om jag vill lägga saker i en godtycklig dict så gör jag det.
 
     if 'cached_permissions' not in user.__dict__:
-        # Fetch permissions from pls and store timestamp
-        response = requests.get(settings.PLS_URL + '/api/user/' + user.username + '/cashflow/')
-        user.__dict__['cached_permissions'] = json.loads(urllib.parse.unquote(response.content.decode('utf-8')))
+        entry = cache.get(permissions_cache_key(user.username))
+        if entry is None:
+            metrics.incr('pls.cache.miss')
+            permissions = fetch_permissions(user.username)
+            if permissions is None:
+                # Better to show the page without admin rights than to hang until pls is back
+                permissions = []
+        elif time.time() - entry['fetched_at'] < settings.PLS_CACHE_TTL:
+            metrics.incr('pls.cache.hit')
+            permissions = entry['permissions']
+        else:
+            metrics.incr('pls.cache.stale')
+            refresh_permissions_in_background(user.username)
+            permissions = entry['permissions']
+        user.__dict__['cached_permissions'] = permissions
 
     return user.__dict__['cached_permissions']
 
+
+def fetch_permissions(username):
+    """
+    Fetch permissions for username from pls and store them in the cache.
+    Returns None if pls could not be reached, gave a bad response or the circuit breaker is open.
+    """
+    if pls_circuit_open():
+        metrics.incr('pls.circuit.rejected')
+        return None
+
+    try:
+        response = outbound.get('pls', settings.PLS_URL + '/api/user/' + username + '/cashflow/')
+        if response.status_code != 200:
+            raise ValueError('status code ' + str(response.status_code))
+        permissions = json.loads(urllib.parse.unquote(response.content.decode('utf-8')))
+        if not isinstance(permissions, list):
+            raise ValueError('expected a list of permissions')
+    except (requests.RequestException, ValueError) as e:
+        print("Could not get permissions from pls:", e)
+        metrics.incr('pls.fetch.failure')
+        _record_pls_failure()
+        return None
+
+    metrics.incr('pls.fetch.success')
+    cache.delete(PLS_FAILURES_KEY)
+    cache.set(permissions_cache_key(username), {
+        'permissions': permissions,
+        'fetched_at': time.time(),
+    }, settings.PLS_CACHE_TTL + settings.PLS_STALE_TTL)
+    return permissions
+
+
+def refresh_permissions_in_background(username):
+    """
+    Fetch permissions for username in a separate thread, unless a refresh is already running.
+    """
+    if not cache.add('pls-refreshing:' + username, True, settings.OUTBOUND_TIMEOUTS['pls'] * 10):
+        return
+
+    def refresh():
+        try:
+            fetch_permissions(username)
+        finally:
+            cache.delete('pls-refreshing:' + username)
+            # The thread got its own database connection through the cache
+            connection.close()
+
+    metrics.incr('pls.refresh.background')
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def pls_circuit_open():
+    """
+    Returns whether calls to pls are paused after repeated failures.
+    """
+    return cache.get(PLS_CIRCUIT_OPEN_KEY, False)
+
+
+def _record_pls_failure():
+    try:
+        failures = cache.incr(PLS_FAILURES_KEY)
+    except ValueError:
+        cache.set(PLS_FAILURES_KEY, 1, None)
+        failures = 1
+
+    if failures >= settings.PLS_CIRCUIT_THRESHOLD:
+        cache.set(PLS_CIRCUIT_OPEN_KEY, True, settings.PLS_CIRCUIT_COOLDOWN)
+        # A single failure after the cool-down opens the circuit again, a success resets it
+        cache.set(PLS_FAILURES_KEY, settings.PLS_CIRCUIT_THRESHOLD - 1, None)
+        metrics.incr('pls.circuit.opened')
+
+
+def permissions_cache_key(username):
+    return 'pls-permissions:' + username
+
+
+def invalidate_permissions(user):
+    """
+    Mark the cached permissions of user as stale, so they are fetched from pls again.
+    The old permissions are kept to be served if pls is unavailable.
+    """
+    key = permissions_cache_key(user.username)
+    entry = cache.get(key)
+    if entry is not None:
+        entry['fetched_at'] = 0
+        cache.set(key, entry, settings.PLS_STALE_TTL)
+    user.__dict__.pop('cached_permissions', None)
+    user.__dict__.pop('permission_set', None)
+
+
+def refresh_permissions(user):
+    """
+    Fetch the permissions of user from pls right away, so that changed rights take effect at once.
+    If pls can't be reached, the old permissions are kept as stale and served until it answers.
+    """
+    if fetch_permissions(user.username) is None:
+        invalidate_permissions(user)
+    else:
+        user.__dict__.pop('cached_permissions', None)
+        user.__dict__.pop('permission_set', None)
+
+
+# Permissions may have changed since the last session, so fetch them again on login
+# noinspection PyUnusedLocal
+@receiver(user_logged_in)
+def refresh_permissions_on_login(sender, request, user, **kwargs):
+    refresh_permissions(user)
+
+
+# noinspection PyUnusedLocal
+@receiver(user_logged_out)
+def clear_permissions_on_logout(sender, request, user, **kwargs):
+    if user is not None:
+        invalidate_permissions(user)
+
+
+def cost_centre_key(cost_centre):
+    """
+    Normalize a cost centre name, from pls or from an expense part, for exact matching.
+    """
+    return cost_centre.strip().lower()
+
+
+class PermissionSet(namedtuple('PermissionSet', [
+    'attest', 'account', 'pay', 'confirm', 'unconfirm', 'view_all'
+])):
+    """
+    The permissions of a user, parsed from the list returned by pls.
+    attest and account are frozensets of cost centre keys, see cost_centre_key, the rest are booleans.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def parse(cls, permissions):
+        attest = set()
+        account = set()
+        for permission in permissions:
+            if permission.startswith("attest-"):
+                attest.add(cost_centre_key(permission[len("attest-"):]))
+            elif permission.startswith("accounting-"):
+                account.add(cost_centre_key(permission[len("accounting-"):]))
+        return cls(
+            attest=frozenset(attest),
+            account=frozenset(account),
+            pay='pay' in permissions,
+            confirm='confirm' in permissions,
+            unconfirm='unconfirm' in permissions,
+            view_all='view-all' in permissions,
+        )
+
+    @property
+    def firmatecknare(self):
+        return 'firmatecknare' in self.attest
+
+    @property
+    def account_all(self):
+        return '*' in self.account
+
+    def may_attest(self, cost_centre):
+        return self.firmatecknare or cost_centre_key(cost_centre) in self.attest
+
+    def may_account(self, cost_centre):
+        return self.account_all or cost_centre_key(cost_centre) in self.account
+
+    def is_admin(self):
+        return bool(self.attest or self.account or self.pay or self.confirm or self.view_all)
+
+
+def get_permission_set(user):
+    """
+    Get the permissions of user as a PermissionSet, parsed once per user object.
+    """
+    if 'permission_set' not in user.__dict__:
+        user.__dict__['permission_set'] = PermissionSet.parse(get_permissions(user))
+    return user.__dict__['permission_set']
+
+
 def has_permission(permission, request):
     """
     Check is user has permission to specific property.
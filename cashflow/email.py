@@ -1,14 +1,19 @@
 import requests
+from cashflow import outbound
 from cashflow import settings
 
 def send_mail(recipient, subject, content):
     if not settings.SEND_EMAILS:
         return
 
-    requests.post(settings.SPAM_URL + '/api/sendmail', json={
-        'from': 'cashflow-no-reply@datasektionen.se',
-        'to': recipient,
-        'subject': subject,
-        'content': content,
-        'key': settings.SPAM_API_KEY
-    })
+    try:
+        outbound.post('spam', settings.SPAM_URL + '/api/sendmail', json={
+            'from': 'cashflow-no-reply@datasektionen.se',
+            'to': recipient,
+            'subject': subject,
+            'content': content,
+            'key': settings.SPAM_API_KEY
+        })
+    except requests.RequestException as e:
+        # A lost notification should not stop the action that triggered it
+        print("Could not reach spam:", e)
@@ -0,0 +1,49 @@
+"""
+Simple in-process metrics.
+
+Counters and timings are kept per worker process and can be read
+through snapshot(), which is exposed to admins at /admin/metrics/.
+"""
+
+import threading
+from collections import defaultdict
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_timings = {}
+
+
+def incr(name, value=1):
+    """
+    Increase the counter name by value.
+    """
+    with _lock:
+        _counters[name] += value
+
+
+def timing(name, seconds):
+    """
+    Record a duration in seconds for name.
+    """
+    with _lock:
+        count, total, maximum = _timings.get(name, (0, 0.0, 0.0))
+        _timings[name] = (count + 1, total + seconds, max(maximum, seconds))
+
+
+def snapshot():
+    """
+    Returns a dict with the current value of all counters and timings.
+    """
+    with _lock:
+        return {
+            'counters': dict(_counters),
+            'timings': {
+                name: {
+                    'count': count,
+                    'total_ms': round(total * 1000, 1),
+                    'mean_ms': round(total * 1000 / count, 1),
+                    'max_ms': round(maximum * 1000, 1),
+                }
+                for name, (count, total, maximum) in _timings.items()
+            },
+        }
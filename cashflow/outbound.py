@@ -0,0 +1,61 @@
+"""
+Shared HTTP client for calls to other systems (pls, login and spam).
+
+All calls go through one session, so connections are kept alive and reused
+between requests. Every call has a timeout, connection errors are retried
+with backoff, and the latency of each call is recorded in cashflow.metrics
+under 'outbound.<service>'.
+"""
+
+import time
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from cashflow import metrics
+
+
+def _create_session():
+    session = requests.Session()
+    # Status codes are only retried for idempotent methods, so an email is never sent twice
+    retry = Retry(
+        total=settings.OUTBOUND_RETRIES,
+        backoff_factor=0.2,
+        status_forcelist=(502, 503, 504),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=len(settings.OUTBOUND_TIMEOUTS), pool_maxsize=10, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+_session = _create_session()
+
+
+def request(service, method, url, **kwargs):
+    """
+    Perform a request to service, which is one of the keys in OUTBOUND_TIMEOUTS.
+    Raises requests.RequestException if the service can not be reached in time.
+    """
+    kwargs.setdefault('timeout', settings.OUTBOUND_TIMEOUTS[service])
+    start = time.monotonic()
+    try:
+        response = _session.request(method, url, **kwargs)
+    except requests.RequestException:
+        metrics.incr('outbound.' + service + '.errors')
+        raise
+    finally:
+        metrics.timing('outbound.' + service, time.monotonic() - start)
+    metrics.incr('outbound.' + service + '.status.' + str(response.status_code))
+    return response
+
+
+def get(service, url, **kwargs):
+    return request(service, 'GET', url, **kwargs)
+
+
+def post(service, url, **kwargs):
+    return request(service, 'POST', url, **kwargs)
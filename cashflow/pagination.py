@@ -0,0 +1,151 @@
+"""
+Opaque cursors for keyset pagination.
+
+A cursor holds the sort key of the last row on a page. The next page is
+read with a WHERE on that key instead of an OFFSET, so every page costs
+the same no matter how deep into the history it is.
+"""
+
+import base64
+import binascii
+import hashlib
+import json
+import operator
+from datetime import date, datetime
+from functools import reduce
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+
+
+def encode_cursor(*values):
+    """
+    Encode the sort key values of a row as a cursor string.
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor, length):
+    """
+    Decode a cursor created by encode_cursor into a list of length values.
+    Raises ValueError if the cursor is not valid.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError('Invalid cursor')
+    return values
+
+
+class Page(object):
+    """
+    One page of rows from paginate, with cursors to the pages before and after it.
+    """
+
+    def __init__(self, items, next_cursor, previous_cursor, count):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.count = count
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+def paginate(queryset, cursor=None, size=25, count_key=None):
+    """
+    Returns the Page of queryset, newest id first, that cursor points to, or the first page if cursor is None.
+    The total count is cached under count_key, or left out if count_key is None.
+    Raises ValueError if the cursor is not valid.
+    """
+    direction, pk = 'next', None
+    if cursor:
+        direction, pk = decode_cursor(cursor, 2)
+        if direction not in ('next', 'previous') or not isinstance(pk, int):
+            raise ValueError('Invalid cursor')
+
+    if direction == 'next':
+        rows = queryset.order_by('-id')
+        if pk is not None:
+            rows = rows.filter(id__lt=pk)
+    else:
+        rows = queryset.order_by('id').filter(id__gt=pk)
+
+    items = list(rows[:size + 1])
+    more = len(items) > size
+    items = items[:size]
+    if direction == 'previous':
+        items.reverse()
+
+    has_next = more if direction == 'next' else True
+    has_previous = pk is not None if direction == 'next' else more
+    count = None
+    if count_key is not None:
+        key = 'pagination-count:' + hashlib.md5(count_key.encode()).hexdigest()
+        count = cache.get_or_set(key, queryset.count, settings.PAGINATION_COUNT_TTL)
+
+    return Page(
+        items,
+        encode_cursor('next', items[-1].id) if items and has_next else None,
+        encode_cursor('previous', items[0].id) if items and has_previous else None,
+        count,
+    )
+
+
+def _cursor_value(value):
+    return value.isoformat() if isinstance(value, (date, datetime)) else value
+
+
+def _after(ordering, values):
+    """
+    Returns a Q matching the rows that come after the row with the given values in ordering.
+    Nulls sort like in PostgreSQL, last in ascending and first in descending order.
+    """
+    after = []
+    equal = Q()
+    for field, value in zip(ordering, values):
+        name = field.lstrip('-')
+        descending = field.startswith('-')
+        if value is None:
+            if descending:
+                after.append(equal & Q(**{name + '__isnull': False}))
+            equal &= Q(**{name + '__isnull': True})
+        else:
+            later = Q(**{name + ('__lt' if descending else '__gt'): value})
+            if not descending:
+                later |= Q(**{name + '__isnull': True})
+            after.append(equal & later)
+            equal &= Q(**{name: value})
+    if not after:
+        return Q(pk__in=[])
+    return reduce(operator.or_, after)
+
+
+def paginate_keyset(rows, ordering, cursor=None, size=25):
+    """
+    Returns the Page of rows, a values() queryset sorted by the fields in ordering, that starts after cursor.
+    The last field in ordering must be unique, and all fields in ordering must be in the rows.
+    Only the next cursor is set on the returned Page. Raises ValueError if the cursor is not valid.
+    """
+    rows = rows.order_by(*ordering)
+    if cursor:
+        rows = rows.filter(_after(ordering, decode_cursor(cursor, len(ordering))))
+
+    items = list(rows[:size + 1])
+    next_cursor = None
+    if len(items) > size:
+        items = items[:size]
+        next_cursor = encode_cursor(*[_cursor_value(items[-1][field.lstrip('-')]) for field in ordering])
+    return Page(items, next_cursor, None, None)
@@ -49,6 +49,7 @@ INSTALLED_APPS = (
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'django.contrib.humanize',
+    'django.contrib.postgres',
     'rest_framework',
     'raven.contrib.django.raven_compat',
     'storages',
@@ -56,6 +57,7 @@ INSTALLED_APPS = (
     'widget_tweaks',
     'expenses',
     'invoices',
+    'stats',
 )
 
 MIDDLEWARE_CLASSES = (
@@ -137,6 +139,18 @@ else:
 db_from_env = dj_database_url.config(conn_max_age=500)
 DATABASES['default'].update(db_from_env)
 
+# Cache
+# https://docs.djangoproject.com/en/1.11/topics/cache/
+# Stored in the database so that it is shared between all gunicorn workers.
+# The table is created by the expenses migrations and by `./manage.py createcachetable`, which the container
+# also runs when it starts, in case the migrations haven't been run yet.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'cashflow_cache',
+    }
+}
+
 # noinspection PyRedeclaration
 SESSION_COOKIE_AGE = 60 * 60 * 24 * 2  # Sessions expire after 2 days
 
@@ -190,5 +204,43 @@ SPAM_URL = os.getenv('SPAM_URL', 'https://spam.datasektionen.se')
 
 PLS_URL = os.getenv('PLS_URL', 'https://pls.datasektionen.se')
 
+# Number of seconds permissions fetched from pls are cached
+PLS_CACHE_TTL = int(os.getenv('PLS_CACHE_TTL', 300))
+# Number of seconds after that old permissions are served while new ones are fetched in the background
+PLS_STALE_TTL = int(os.getenv('PLS_STALE_TTL', 60 * 60 * 24))
+# Stop calling pls for PLS_CIRCUIT_COOLDOWN seconds after PLS_CIRCUIT_THRESHOLD failures in a row
+PLS_CIRCUIT_THRESHOLD = int(os.getenv('PLS_CIRCUIT_THRESHOLD', 5))
+PLS_CIRCUIT_COOLDOWN = int(os.getenv('PLS_CIRCUIT_COOLDOWN', 60))
+
+# Seconds to cache the total counts shown on paginated lists, see cashflow/pagination.py
+PAGINATION_COUNT_TTL = int(os.getenv('PAGINATION_COUNT_TTL', 300))
+
+# Seconds to cache the queue counts in the admin navigation, they are also invalidated when the queues change
+ADMIN_COUNTS_TTL = int(os.getenv('ADMIN_COUNTS_TTL', 60))
+
+# Seconds to cache the statistics of the current year, they are also invalidated when expenses change.
+# Statistics of past years are cached until they are invalidated.
+STATS_CACHE_TTL = int(os.getenv('STATS_CACHE_TTL', 300))
+
+# The account that payments are made from in exported bank files, see expenses/bankfile.py
+BANK_FILE_DEBTOR_NAME = os.getenv('BANK_FILE_DEBTOR_NAME', 'Konglig Datasektionen')
+BANK_FILE_DEBTOR_ACCOUNT = os.getenv('BANK_FILE_DEBTOR_ACCOUNT', '')
+BANK_FILE_DEBTOR_BIC = os.getenv('BANK_FILE_DEBTOR_BIC', '')
+
+# Company name and accounts in the SIE export, see expenses/sie.py. Cashflow has no chart of accounts, so all parts
+# are booked on the cost account and all payments on the bank account.
+SIE_COMPANY_NAME = os.getenv('SIE_COMPANY_NAME', 'Konglig Datasektionen')
+SIE_COST_ACCOUNT = int(os.getenv('SIE_COST_ACCOUNT', 4000))
+SIE_BANK_ACCOUNT = int(os.getenv('SIE_BANK_ACCOUNT', 1930))
+
+# Timeouts in seconds for requests to other systems, see cashflow/outbound.py
+OUTBOUND_TIMEOUTS = {
+    'pls': float(os.getenv('PLS_TIMEOUT', 3)),
+    'login': float(os.getenv('LOGIN_TIMEOUT', 5)),
+    'spam': float(os.getenv('SPAM_TIMEOUT', 10)),
+}
+# Number of times a failed connection to another system is retried
+OUTBOUND_RETRIES = int(os.getenv('OUTBOUND_RETRIES', 2))
+
 # Only send emails if set to true
 SEND_EMAILS = (os.getenv('SEND_EMAILS', True) == 'True')
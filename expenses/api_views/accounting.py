@@ -19,10 +19,10 @@ class AccountingViewSet(GenericViewSet):
         expenses__ready_for_accounting = []
 
         # Add all expenses that the user will do accounting for
-        for expense in Expense.objects.filter(
+        for expense in Expense.with_related(Expense.objects.filter(
                         expensepart__attested_by__isnull=False,
                         reimbursement__isnull=False
-                ).distinct():
+                ).distinct()):
             if may_account(expense, request):
                 expenses__ready_for_accounting.append(expense.to_dict())
 
@@ -22,7 +22,7 @@ class AttestViewSet(GenericViewSet):
         expenses__to_attest = []
 
         # Add all expenses that the user may attest
-        for expense in Expense.objects.filter(expensepart__attested_by__isnull=True).distinct():
+        for expense in Expense.with_related(Expense.objects.filter(expensepart__attested_by__isnull=True).distinct()):
             if may_attest_expense(expense, request):
                 expenses__to_attest.append(expense.to_dict())
 
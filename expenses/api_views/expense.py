@@ -25,7 +25,7 @@ class ExpenseViewSet(GenericViewSet):
     def list(self, request, **kwargs):
         expenses_user_may_view = []
 
-        for exp in Expense.objects.all():
+        for exp in Expense.with_related(Expense.objects.all()):
             if may_view_expense(exp, request):
                 expenses_user_may_view.append(exp)
 
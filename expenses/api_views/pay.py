@@ -22,7 +22,8 @@ class PaymentViewSet(GenericViewSet):
     def list(self, request, **kwargs):
         if has_permission("admin", request):
             return Response({
-                'payments': [payment.to_dict() for payment in Payment.objects.all()]
+                'payments': [payment.to_dict() for payment in
+                             Payment.objects.select_related('payer__user', 'receiver__user', 'account')]
             })
         else:
             return Response(status=status.HTTP_403_FORBIDDEN)
@@ -69,11 +70,11 @@ class PaymentViewSet(GenericViewSet):
         expenses = []
 
         # Retrieve all expenses which are not reimbursed
-        to_be_paid_expenses = Expense.objects.filter(reimbursement__isnull=True)
+        to_be_paid_expenses = Expense.with_related(Expense.objects.filter(reimbursement__isnull=True))
 
         # Filter out the expenses with all parts attested
         for expense in to_be_paid_expenses:
-            if len(expense.expensepart_set.filter(attested_by__isnull=True)) == 0:  # All parts attested
+            if all(part.attested_by_id is not None for part in expense.expensepart_set.all()):  # All parts attested
                 expenses.append(expense.to_dict())
 
         return JsonResponse({'ready_for_payment': expenses})
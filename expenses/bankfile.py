@@ -0,0 +1,130 @@
+"""
+Bank upload files for payments, so that transfers don't have to be typed into the bank by hand.
+
+The files are generated piece by piece from a queryset of payments, so that
+they can be streamed with a StreamingHttpResponse without building the whole
+document in memory. Each transfer carries the payment tag ("Data<id>") as its
+message, which is what the statement import matches on.
+"""
+
+import csv
+import uuid
+from datetime import date, datetime
+from xml.sax.saxutils import escape
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Count, Sum
+
+PAIN_NAMESPACE = 'urn:iso:std:iso:20022:tech:xsd:pain.001.001.03'
+
+CSV_HEADER = ['Meddelande', 'Mottagare', 'Bank', 'Clearingnummer', 'Kontonummer', 'Belopp']
+
+
+def export_payments(payments):
+    """
+    Returns the payments with their receivers and accounts loaded, in the order they are exported.
+    """
+    return payments.select_related('receiver__user', 'account').order_by('id')
+
+
+def _amount(value):
+    return '%.2f' % value
+
+
+def _name(profile):
+    return profile.user.first_name + ' ' + profile.user.last_name
+
+
+class _Echo(object):
+    """
+    A file-like object for csv.writer that returns what is written instead of storing it.
+    """
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(payments):
+    """
+    Yields the lines of a CSV file with one transfer per payment.
+    """
+    writer = csv.writer(_Echo())
+    yield writer.writerow(CSV_HEADER)
+    for payment in export_payments(payments).iterator():
+        yield writer.writerow([
+            payment.tag(),
+            _name(payment.receiver),
+            payment.receiver.bank_name,
+            payment.receiver.sorting_number,
+            payment.receiver.bank_account,
+            _amount(payment.total),
+        ])
+
+
+def check_debtor_account():
+    """
+    Raises ImproperlyConfigured if BANK_FILE_DEBTOR_ACCOUNT is not set, since the bank rejects transfers without it.
+    """
+    if not settings.BANK_FILE_DEBTOR_ACCOUNT.strip():
+        raise ImproperlyConfigured('BANK_FILE_DEBTOR_ACCOUNT must be set to export pain.001 files')
+
+
+def pain001_chunks(payments, execution_date=None):
+    """
+    Returns the parts of an ISO 20022 pain.001.001.03 credit transfer initiation with one transfer per payment,
+    all from the account in BANK_FILE_DEBTOR_ACCOUNT. Receiver accounts are given as clearing number and account
+    number (BBAN). Raises ImproperlyConfigured right away, not when streaming, if the account is not set.
+    """
+    check_debtor_account()
+    return _pain001_chunks(payments, execution_date)
+
+
+def _pain001_chunks(payments, execution_date):
+    payments = export_payments(payments)
+    summary = payments.aggregate(count=Count('id'), total=Sum('total'))
+    execution_date = execution_date or date.today()
+    message_id = uuid.uuid4().hex
+
+    if settings.BANK_FILE_DEBTOR_BIC:
+        debtor_agent = '<BIC>' + escape(settings.BANK_FILE_DEBTOR_BIC) + '</BIC>'
+    else:
+        debtor_agent = '<Othr><Id>NOTPROVIDED</Id></Othr>'
+
+    yield (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<Document xmlns="' + PAIN_NAMESPACE + '">\n'
+        '<CstmrCdtTrfInitn>\n'
+        '<GrpHdr>'
+        '<MsgId>' + message_id + '</MsgId>'
+        '<CreDtTm>' + datetime.now().replace(microsecond=0).isoformat() + '</CreDtTm>'
+        '<NbOfTxs>' + str(summary['count']) + '</NbOfTxs>'
+        '<CtrlSum>' + _amount(summary['total'] or 0) + '</CtrlSum>'
+        '<InitgPty><Nm>' + escape(settings.BANK_FILE_DEBTOR_NAME) + '</Nm></InitgPty>'
+        '</GrpHdr>\n'
+        '<PmtInf>'
+        '<PmtInfId>' + message_id + '-1</PmtInfId>'
+        '<PmtMtd>TRF</PmtMtd>'
+        '<NbOfTxs>' + str(summary['count']) + '</NbOfTxs>'
+        '<CtrlSum>' + _amount(summary['total'] or 0) + '</CtrlSum>'
+        '<ReqdExctnDt>' + execution_date.isoformat() + '</ReqdExctnDt>'
+        '<Dbtr><Nm>' + escape(settings.BANK_FILE_DEBTOR_NAME) + '</Nm></Dbtr>'
+        '<DbtrAcct><Id><Othr><Id>' + escape(settings.BANK_FILE_DEBTOR_ACCOUNT) + '</Id>'
+        '<SchmeNm><Cd>BBAN</Cd></SchmeNm></Othr></Id></DbtrAcct>'
+        '<DbtrAgt><FinInstnId>' + debtor_agent + '</FinInstnId></DbtrAgt>\n'
+    )
+
+    for payment in payments.iterator():
+        receiver = payment.receiver
+        yield (
+            '<CdtTrfTxInf>'
+            '<PmtId><EndToEndId>' + payment.tag() + '</EndToEndId></PmtId>'
+            '<Amt><InstdAmt Ccy="SEK">' + _amount(payment.total) + '</InstdAmt></Amt>'
+            '<Cdtr><Nm>' + escape(_name(receiver)) + '</Nm></Cdtr>'
+            '<CdtrAcct><Id><Othr><Id>' + escape(receiver.sorting_number + receiver.bank_account) + '</Id>'
+            '<SchmeNm><Cd>BBAN</Cd></SchmeNm></Othr></Id></CdtrAcct>'
+            '<RmtInf><Ustrd>' + payment.tag() + '</Ustrd></RmtInf>'
+            '</CdtTrfTxInf>\n'
+        )
+
+    yield '</PmtInf>\n</CstmrCdtTrfInitn>\n</Document>\n'
@@ -0,0 +1,181 @@
+import random
+import re
+from datetime import date, timedelta
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from cashflow import dauth
+from expenses.models import BankAccount, Comment, Expense, ExpensePart, Payment, Profile
+from invoices.models import Invoice, InvoicePart
+from stats.models import ExpenseRollup
+
+# Tables that are large in production and must never be read with a sequential scan by the hot queries
+LARGE_TABLES = (
+    'expenses_expense',
+    'expenses_expensepart',
+    'expenses_comment',
+    'invoices_invoice',
+    'invoices_invoicepart',
+)
+
+COST_CENTRES = ['Nämnd ' + str(n) for n in range(40)]
+
+
+class Command(BaseCommand):
+    help = 'Seeds a large history of expenses and invoices and checks with EXPLAIN that the queue, ' \
+           'stats and listing queries use indexes. The seeded data is rolled back afterwards.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--expenses', type=int, default=100000, help='Number of expenses to seed.')
+        parser.add_argument('--verbose-plans', action='store_true', help='Print the full query plans.')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.seed(options['expenses'])
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+            failures = self.explain_all(options['verbose_plans'])
+            transaction.set_rollback(True)
+
+        if failures:
+            raise CommandError('Sequential scans on large tables in: ' + ', '.join(failures))
+        self.stdout.write('All queries use indexes')
+
+    def seed(self, count):
+        self.stdout.write('Seeding ' + str(count) + ' expenses...')
+        rand = random.Random(0)
+        today = date.today()
+        first = date(today.year - 9, 1, 1)
+        days = (today - first).days
+
+        users = User.objects.bulk_create(
+            User(username='explain-' + str(n), first_name='Explain', last_name=str(n)) for n in range(500)
+        )
+        profiles = Profile.objects.bulk_create(Profile(user=user) for user in users)
+        account = BankAccount.objects.create(name='Explain')
+
+        expenses = []
+        for n in range(count):
+            # Most of the history is accounted, only the newest expenses are still in the queues
+            roll = rand.random()
+            if n < count * 0.9:
+                state = Expense.ACCOUNTED
+            else:
+                state = rand.choice([Expense.UNATTESTED, Expense.ATTESTED, Expense.PAYABLE, Expense.PAID])
+            expenses.append(Expense(
+                expense_date=first + timedelta(days=int(days * n / count)),
+                owner=rand.choice(profiles),
+                description='Utlägg ' + str(n),
+                confirmed_by=None if state in (Expense.UNATTESTED, Expense.ATTESTED) and roll < 0.8 else users[0],
+                verification='E' + str(n) if state == Expense.ACCOUNTED else '',
+                verification_series='E' if state == Expense.ACCOUNTED else '',
+                verification_number=n if state == Expense.ACCOUNTED else None,
+                verification_year=(first + timedelta(days=int(days * n / count))).year
+                if state == Expense.ACCOUNTED else None,
+                state=state,
+            ))
+
+        payments = Payment.objects.bulk_create(
+            Payment(payer=profiles[0], receiver=profiles[0], account=account) for _ in range(count // 5 + 1)
+        )
+        for n, expense in enumerate(expenses):
+            if expense.state in (Expense.PAID, Expense.ACCOUNTED):
+                expense.reimbursement = payments[n // 5]
+        expenses = Expense.objects.bulk_create(expenses, batch_size=5000)
+
+        parts = []
+        comments = []
+        for expense in expenses:
+            for _ in range(rand.randint(1, 3)):
+                cost_centre = rand.choice(COST_CENTRES)
+                parts.append(ExpensePart(
+                    expense=expense,
+                    cost_centre=cost_centre,
+                    cost_centre_key=dauth.cost_centre_key(cost_centre),
+                    secondary_cost_centre='Projekt',
+                    budget_line='Mat',
+                    amount=Decimal(rand.randint(10, 2000)),
+                    attested_by=None if expense.state == Expense.UNATTESTED else profiles[1],
+                ))
+            comments.append(Comment(expense=expense, author=profiles[1], content='Attesterar'))
+        ExpensePart.objects.bulk_create(parts, batch_size=5000)
+        Comment.objects.bulk_create(comments, batch_size=5000)
+
+        invoices = []
+        for n in range(count // 10):
+            state = Invoice.ACCOUNTED if n < count // 10 * 0.9 else \
+                rand.choice([Invoice.UNATTESTED, Invoice.PAYABLE, Invoice.PAID])
+            invoices.append(Invoice(
+                due_date=first + timedelta(days=int(days * n / (count // 10))),
+                owner=rand.choice(profiles),
+                description='Faktura ' + str(n),
+                file_is_original=True,
+                verification='E' + str(count + n) if state == Invoice.ACCOUNTED else '',
+                verification_series='E' if state == Invoice.ACCOUNTED else '',
+                verification_number=count + n if state == Invoice.ACCOUNTED else None,
+                verification_year=first.year if state == Invoice.ACCOUNTED else None,
+                payed_at=None if state in (Invoice.UNATTESTED, Invoice.PAYABLE) else first,
+                state=state,
+            ))
+        invoices = Invoice.objects.bulk_create(invoices, batch_size=5000)
+        InvoicePart.objects.bulk_create((
+            InvoicePart(
+                invoice=invoice,
+                cost_centre=COST_CENTRES[invoice.id % len(COST_CENTRES)],
+                cost_centre_key=dauth.cost_centre_key(COST_CENTRES[invoice.id % len(COST_CENTRES)]),
+                amount=Decimal(100),
+                attested_by=None if invoice.state == Invoice.UNATTESTED else profiles[1],
+            ) for invoice in invoices
+        ), batch_size=5000)
+
+        self.expense = expenses[count // 2]
+        self.owner = profiles[2]
+
+    def queries(self):
+        committee = frozenset({dauth.cost_centre_key(COST_CENTRES[3])})
+        year = date.today().year - 1
+        paid = list(Expense.objects.filter(reimbursement__isnull=False).order_by('-id').values_list('pk', flat=True)[:50])
+        return [
+            ('attest queue', Expense.view_attestable(committee, None)),
+            ('attest queue, all', Expense.view_attestable(frozenset({'*'}), None)),
+            ('confirm queue', Expense.confirmable().order_by('id')),
+            ('pay queue', Expense.payable()),
+            ('account queue', Expense.view_accountable(committee)),
+            ('account queue, all', Expense.view_accountable(frozenset({'*'}))),
+            ('invoice attest queue', Invoice.view_attestable(committee, None)),
+            ('invoice pay queue', Invoice.payable()),
+            ('invoice account queue', Invoice.view_accountable(frozenset({'*'}))),
+            ('unattested parts', self.expense.expensepart_set.filter(attested_by__isnull=True)),
+            ('comments', self.expense.comment_set.all()),
+            ('stats rollup, paid parts', ExpenseRollup.part_groups(ExpensePart.objects.filter(expense_id__in=paid))),
+            ('stats rollup, paid expenses', ExpenseRollup.expense_groups(Expense.objects.filter(pk__in=paid))),
+            ('expense list, cost centre', Expense.objects.order_by('-id', '-expense_date')
+                .filter(expensepart__cost_centre=COST_CENTRES[3]).distinct()[:25]),
+            ('invoice list, unpaid', Invoice.objects.filter(payed_at__isnull=True).order_by('due_date')[:25]),
+            ('verification list', Expense.verification_sequence('E', year)[:25]),
+            ('verification numbers', Expense.verification_numbers('E', year)),
+            ('user receipts, unpaid', Expense.objects.filter(owner=self.owner, reimbursement__isnull=True)),
+        ]
+
+    def explain_all(self, verbose_plans):
+        failures = []
+        with connection.cursor() as cursor:
+            for name, queryset in self.queries():
+                sql, params = queryset.query.sql_with_params()
+                cursor.execute('EXPLAIN ' + sql, params)
+                plan = '\n'.join(row[0] for row in cursor.fetchall())
+
+                indexes = sorted(set(re.findall(r'(?:Index Scan|Index Only Scan) (?:Backward )?using (\w+)', plan) +
+                                     re.findall(r'Bitmap Index Scan on (\w+)', plan)))
+                scanned = [table for table in LARGE_TABLES if re.search(r'Seq Scan on ' + table + r'\b', plan)]
+                if scanned:
+                    failures.append(name)
+                self.stdout.write('%-28s %-4s %s' % (
+                    name, 'SEQ' if scanned else 'OK', ', '.join(indexes) or '-'
+                ))
+                if verbose_plans or scanned:
+                    self.stdout.write(plan)
+        return failures
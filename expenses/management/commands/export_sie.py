@@ -0,0 +1,22 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from expenses import sie
+
+
+class Command(BaseCommand):
+    help = 'Writes the SIE4 file with the reimbursed expenses and paid invoices of a year.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('year', type=int)
+        parser.add_argument('--output', help='File to write to instead of standard output.')
+
+    def handle(self, *args, **options):
+        output = open(options['output'], 'wb') if options['output'] else sys.stdout.buffer
+        try:
+            for line in sie.export(options['year']):
+                output.write(line)
+        finally:
+            if options['output']:
+                output.close()
@@ -0,0 +1,32 @@
+from itertools import chain
+
+from django.core.management.base import BaseCommand, CommandError
+
+from expenses import statements
+
+
+class Command(BaseCommand):
+    help = 'Marks the payments found in bank statements (camt.053 or CSV) as reconciled and reports unmatched rows.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+', help='Statement files, CSV files must end in .csv.')
+
+    def handle(self, *args, **options):
+        files = [open(name, 'rb') for name in options['files']]
+        try:
+            result = statements.reconcile(chain.from_iterable(
+                statements.transactions(file, file.name) for file in files
+            ))
+        except statements.StatementError as e:
+            raise CommandError('Could not read the statements: ' + str(e))
+        finally:
+            for file in files:
+                file.close()
+
+        for error in result['errors']:
+            self.stdout.write('{date} {amount} {text}: {error}'.format(
+                **{key: '' if value is None else value for key, value in error.items()}
+            ))
+        self.stdout.write(
+            'Reconciled ' + str(result['matched']) + ' payments, ' + str(len(result['errors'])) + ' rows did not match'
+        )
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F, Sum
+from django.db.models.functions import Coalesce
+
+from expenses.models import Expense, Payment
+from invoices.models import Invoice
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the stored totals of expenses, invoices and payments from their parts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify', action='store_true',
+            help='Only report stored totals that are wrong, without changing them.',
+        )
+
+    def handle(self, *args, **options):
+        if options['verify']:
+            wrong = self.count_wrong()
+            if wrong:
+                raise CommandError(str(wrong) + ' stored totals are wrong, run update_totals to fix them')
+            self.stdout.write('All stored totals are correct')
+            return
+
+        # Payments are summed from expense totals, so they have to be updated last
+        with transaction.atomic():
+            Expense.update_totals(Expense.objects.values('pk'))
+            Invoice.update_totals(Invoice.objects.values('pk'))
+            Payment.update_totals(Payment.objects.values('pk'))
+        self.stdout.write('Updated the totals of all expenses, invoices and payments')
+
+    def count_wrong(self):
+        wrong = 0
+        for name, queryset in [
+            ('expenses', Expense.objects.annotate(expected=Coalesce(Sum('expensepart__amount'), 0))),
+            ('invoices', Invoice.objects.annotate(expected=Coalesce(Sum('invoicepart__amount'), 0))),
+            ('payments', Payment.objects.annotate(expected=Coalesce(Sum('expense__total'), 0))),
+        ]:
+            ids = list(queryset.exclude(total=F('expected')).values_list('pk', flat=True))
+            if ids:
+                self.stdout.write(name + ' with wrong totals: ' + ', '.join(str(pk) for pk in ids))
+            wrong += len(ids)
+        return wrong
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.15 on 2026-10-18 03:16
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0024_auto_20240516_1926'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='expense',
+            name='total',
+            field=models.DecimalField(db_index=True, decimal_places=2, default=0, editable=False, max_digits=11),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='total',
+            field=models.DecimalField(db_index=True, decimal_places=2, default=0, editable=False, max_digits=11),
+        ),
+        migrations.RunSQL(
+            'UPDATE expenses_expense SET total = COALESCE('
+            '(SELECT SUM(amount) FROM expenses_expensepart WHERE expense_id = expenses_expense.id), 0)',
+            migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(
+            'UPDATE expenses_payment SET total = COALESCE('
+            '(SELECT SUM(total) FROM expenses_expense WHERE reimbursement_id = expenses_payment.id), 0)',
+            migrations.RunSQL.noop,
+        ),
+    ]
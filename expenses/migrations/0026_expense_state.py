@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.15 on 2026-10-18 04:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0025_expense_total'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='expense',
+            name='state',
+            field=models.CharField(choices=[('unattested', 'Inte attesterad'), ('attested', 'Attesterad men inte bekräftad av kassör'), ('payable', 'Inväntar utbetalning'), ('paid', 'Utbetald'), ('accounted', 'Bokförd')], default='unattested', editable=False, max_length=10),
+        ),
+        migrations.RunSQL(
+            "UPDATE expenses_expense SET state = CASE "
+            "WHEN verification <> '' THEN 'accounted' "
+            "WHEN reimbursement_id IS NOT NULL THEN 'paid' "
+            "WHEN EXISTS (SELECT 1 FROM expenses_expensepart "
+            "WHERE expense_id = expenses_expense.id AND attested_by_id IS NULL) "
+            "OR NOT EXISTS (SELECT 1 FROM expenses_expensepart WHERE expense_id = expenses_expense.id) THEN 'unattested' "
+            "WHEN confirmed_by_id IS NOT NULL THEN 'payable' "
+            "ELSE 'attested' END",
+            migrations.RunSQL.noop,
+        ),
+        # The queues only ever read a small part of the table, so they get partial indexes
+        migrations.RunSQL(
+            "CREATE INDEX expenses_expense_attest_queue ON expenses_expense (id) WHERE state = 'unattested'",
+            'DROP INDEX expenses_expense_attest_queue',
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX expenses_expense_confirm_queue ON expenses_expense (id) WHERE confirmed_by_id IS NULL',
+            'DROP INDEX expenses_expense_confirm_queue',
+        ),
+        migrations.RunSQL(
+            "CREATE INDEX expenses_expense_pay_queue ON expenses_expense (owner_id) WHERE state = 'payable'",
+            'DROP INDEX expenses_expense_pay_queue',
+        ),
+        migrations.RunSQL(
+            "CREATE INDEX expenses_expense_account_queue ON expenses_expense (expense_date) WHERE state = 'paid'",
+            'DROP INDEX expenses_expense_account_queue',
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX expenses_expensepart_unattested ON expenses_expensepart (expense_id) '
+            'WHERE attested_by_id IS NULL',
+            'DROP INDEX expenses_expensepart_unattested',
+        ),
+    ]
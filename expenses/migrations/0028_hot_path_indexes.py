@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.15 on 2026-10-18 03:23
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0027_expensepart_cost_centre_key'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='expense',
+            name='expense_date',
+            field=models.DateField(db_index=True),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['expense', 'date'], name='comment_expense_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['invoice', 'date'], name='comment_invoice_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expensepart',
+            index=models.Index(fields=['expense', 'attested_by'], name='expensepart_attest_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expensepart',
+            index=models.Index(fields=['cost_centre', 'secondary_cost_centre', 'budget_line'], name='expensepart_cost_centre_idx'),
+        ),
+        # Stats only count reimbursed expenses, by year
+        migrations.RunSQL(
+            'CREATE INDEX expenses_expense_reimbursed_date ON expenses_expense (expense_date) '
+            'WHERE reimbursement_id IS NOT NULL',
+            'DROP INDEX expenses_expense_reimbursed_date',
+        ),
+        # The receipts of a user that have not been paid yet
+        migrations.RunSQL(
+            'CREATE INDEX expenses_expense_unpaid_owner ON expenses_expense (owner_id) '
+            'WHERE reimbursement_id IS NULL',
+            'DROP INDEX expenses_expense_unpaid_owner',
+        ),
+        # The verification list of a year
+        migrations.RunSQL(
+            "CREATE INDEX expenses_expense_verified_date ON expenses_expense (expense_date) "
+            "WHERE verification <> ''",
+            'DROP INDEX expenses_expense_verified_date',
+        ),
+    ]
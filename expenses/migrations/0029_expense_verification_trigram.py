@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.15 on 2026-10-18 05:12
+from __future__ import unicode_literals
+
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0028_hot_path_indexes'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AlterField(
+            model_name='expense',
+            name='verification',
+            field=models.CharField(blank=True, db_index=True, max_length=7),
+        ),
+        # Used by Expense.search_verification for substring and similarity matches
+        migrations.RunSQL(
+            'CREATE INDEX expenses_expense_verification_trgm ON expenses_expense '
+            'USING gin (verification gin_trgm_ops)',
+            'DROP INDEX expenses_expense_verification_trgm',
+        ),
+    ]
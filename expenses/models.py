@@ -1,17 +1,27 @@
+import operator
 import re
+from collections import OrderedDict
 from datetime import date
+from functools import reduce
 
 import requests
 from django.contrib.auth.models import User
-from django.db import models
-from django.db.models.signals import post_save
-from django.dispatch import receiver
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, SearchVectorField, TrigramSimilarity
+from django.db import models, transaction
+from django.db.models import Case, DecimalField, F, FloatField, IntegerField, Max, OuterRef, Prefetch, Q, \
+    Subquery, Sum, TextField, Value, When
+from django.db.models.functions import Cast, Coalesce
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
 from django.forms.models import model_to_dict
 from django.template.loader import render_to_string
 
 from cashflow import dauth
 from cashflow import settings
 from cashflow import email
+from expenses import queues
 from invoices.models import Invoice
 
 
@@ -91,24 +101,24 @@ class Profile(models.Model):
             }
         }
 
-    # Returns a list of the cost centres that the user may attest
+    # Returns the parsed permissions of the user
+    def permissions(self):
+        return dauth.get_permission_set(self.user)
+
+    # Returns a set of the cost centres that the user may attest
     def may_attest(self, expense_part=None):
-        may_attest = []
-        for permission in dauth.get_permissions(self.user):
-            if permission.startswith("attest-"):
-                may_attest.append(permission[len("attest-"):].lower())
         if expense_part is None:
-            return may_attest
-        return 'firmatecknare' in may_attest or expense_part.cost_centre.lower() in may_attest
+            return self.permissions().attest
+        return self.permissions().may_attest(expense_part.cost_centre)
 
     def may_view_attest(self):
         if self.may_view_all():
-            return ['.*']
+            return frozenset({'*'})
         return self.may_attest()
 
     # Returns whether the user is allowed to make reimbursements
     def may_pay(self):
-        return 'pay' in dauth.get_permissions(self.user)
+        return self.permissions().pay
 
     # Returns whether the user may view payable expenses
     def may_view_pay(self):
@@ -116,60 +126,48 @@ class Profile(models.Model):
 
     # Returns whether the user may confirm expenses
     def may_confirm(self):
-        return 'confirm' in dauth.get_permissions(self.user)
+        return self.permissions().confirm
 
     # Returns a list of the cost centres that the user may pay for
     def may_unconfirm(self):
-        return 'unconfirm' in dauth.get_permissions(self.user)
+        return self.permissions().unconfirm
 
     # Returns whether the user may view confirmable expenses
     def may_view_confirm(self):
         return self.may_view_all() or self.may_confirm()
 
-    # Returns a list of the cost centres that the user may account for
+    # Returns a set of the cost centres that the user may account for
     def may_account(self, expense=None, invoice=None):
-        if 'accounting-*' in dauth.get_permissions(self.user) and (expense is not None or invoice is not None):
-            return True
-
-        may_account = []
-        for permission in dauth.get_permissions(self.user):
-            if permission.startswith("accounting-"):
-                may_account.append(permission[len("accounting-"):].lower())
+        permissions = self.permissions()
         if expense is None and invoice is None:
-            return may_account
+            return permissions.account
+        if permissions.account_all:
+            return True
 
-        if expense is not None:
-            for ep in expense.expensepart_set.all():
-                if ep.cost_centre.lower() in may_account:
-                    return True
-        else:
-            for ip in invoice.invoicepart_set.all():
-                if ip.cost_centre.lower() in may_account:
-                    return True
-        return False
+        parts = expense.expensepart_set.all() if expense is not None else invoice.invoicepart_set.all()
+        return any(permissions.may_account(part.cost_centre) for part in parts)
 
     def may_view_account(self):
         if self.may_view_all():
-            return ['.*']
+            return frozenset({'*'})
         return self.may_account()
 
     def may_delete(self, expense):
         if expense.reimbursement:
             return False
-        if 'attest-firmatecknare' in dauth.get_permissions(self.user) and expense is not None:
+        if self.permissions().firmatecknare and expense is not None:
             return True
         if expense.owner.user.username == self.user.username:
             return True
         return False
     
     def firmatecknare(self):
-        if 'attest-firmatecknare' in dauth.get_permissions(self.user):
-            return True
+        return self.permissions().firmatecknare
 
     def may_delete_invoice(self, invoice):
         if invoice is None or invoice.is_payed():
             return False
-        if 'attest-firmatecknare' in dauth.get_permissions(self.user):
+        if self.permissions().firmatecknare:
             return True
         if invoice.owner.user.username == self.user.username:
             return True
@@ -181,8 +179,10 @@ class Profile(models.Model):
     def may_view_expense(self, expense):
         if expense.owner.user.username == self.user.username or self.may_pay() or self.may_view_all():
             return True
+        permissions = self.permissions()
         for cost_centre in expense.cost_centres():
-            if cost_centre['cost_centre'].lower() in self.may_account() or cost_centre['cost_centre'].lower() in self.may_attest():
+            key = dauth.cost_centre_key(cost_centre['cost_centre'])
+            if key in permissions.account or key in permissions.attest:
                 return True
 
         return False
@@ -190,20 +190,22 @@ class Profile(models.Model):
     def may_view_invoice(self, invoice):
         if invoice.owner.user.username == self.user.username or self.may_pay() or self.may_view_all():
             return True
+        permissions = self.permissions()
         for cost_centre in invoice.cost_centres():
-            if cost_centre['cost_centre'].lower() in self.may_account() or cost_centre['cost_centre'].lower() in self.may_attest():
+            key = dauth.cost_centre_key(cost_centre['cost_centre'])
+            if key in permissions.account or key in permissions.attest:
                 return True
 
         return False
 
     def may_view_all(self):
-        return 'view-all' in dauth.get_permissions(self.user)
+        return self.permissions().view_all
 
     def is_admin(self):
-        return self.may_attest() or self.may_pay() or self.may_confirm() or self.may_account() or self.may_view_all()
+        return self.permissions().is_admin()
 
     def may_unattest(self):
-        return 'attest-firmatecknare' in dauth.get_permissions(self.user)
+        return self.permissions().firmatecknare
 
 
 # Based of https://simpleisbetterthancomplex.com/tutorial/2016/07/22/how-to-extend-django-user-model.html#onetoone
@@ -220,6 +222,10 @@ def save_user_profile(sender, instance, **kwargs):
     instance.profile.save()
 
 
+# Sent by Payment.run with the ids of the expenses that it has reimbursed without saving them
+expenses_reimbursed = Signal(providing_args=['expense_ids'])
+
+
 class Payment(models.Model):
     """
     Represents a payment from a chapter account to a member.
@@ -228,6 +234,10 @@ class Payment(models.Model):
     payer = models.ForeignKey(Profile, related_name='payer')
     receiver = models.ForeignKey(Profile, related_name='receiver')
     account = models.ForeignKey(BankAccount)
+    # Sum of the expenses in the payment, kept up to date by Payment.update_totals
+    total = models.DecimalField(max_digits=11, decimal_places=2, default=0, editable=False, db_index=True)
+    # Booking date of the payment on an imported bank statement, see expenses/statements.py
+    reconciled = models.DateField(null=True, blank=True)
 
     # Return a string representation of the payment
     def __str__(self):
@@ -249,15 +259,107 @@ class Payment(models.Model):
 
     # Returns the total amount of the payment
     def amount(self):
-        total = 0
-        for expense in Expense.objects.filter(reimbursement=self):
-            total += expense.total_amount()
-        return total
+        return self.total
+
+    # Recomputes the stored total of the given payments from their expenses
+    @staticmethod
+    def update_totals(payment_ids):
+        expense_totals = Expense.objects.filter(reimbursement=OuterRef('pk')).order_by() \
+            .values('reimbursement').annotate(sum=Sum('total')).values('sum')
+        Payment.objects.filter(pk__in=payment_ids).update(
+            total=Coalesce(Subquery(expense_totals, output_field=DecimalField()), 0)
+        )
 
     # Returns the payment tag, which makes the payment identifiable in the bank
     def tag(self):
         return "Data" + str(self.id)
 
+    # Pays all payable expenses, or the payable ones among expense_ids, with one payment per owner from account.
+    # Everything happens in one transaction on locked rows. Owners without bank details are skipped.
+    # Returns a summary with the payments made and the owners skipped.
+    @staticmethod
+    def run(payer, account, expense_ids=None):
+        with transaction.atomic():
+            # Only the expenses are locked, the owners are loaded separately so that their rows aren't locked too
+            expenses = Expense.objects.filter(state=Expense.PAYABLE).select_for_update().order_by('id')
+            if expense_ids is not None:
+                expenses = expenses.filter(pk__in=expense_ids)
+            expenses = list(expenses)
+            owners = Profile.objects.select_related('user').in_bulk({expense.owner_id for expense in expenses})
+
+            by_owner = OrderedDict()
+            for expense in sorted(expenses, key=lambda expense: (owners[expense.owner_id].user.username, expense.id)):
+                expense.owner = owners[expense.owner_id]
+                by_owner.setdefault(expense.owner_id, []).append(expense)
+
+            payments = []
+            skipped = []
+            for owner_expenses in by_owner.values():
+                owner = owner_expenses[0].owner
+                total = sum(expense.total for expense in owner_expenses)
+                if owner.bank_name == "" or owner.bank_account == "" or owner.sorting_number == "":
+                    skipped.append({
+                        'receiver': owner.user_dict(),
+                        'expenses': [expense.id for expense in owner_expenses],
+                        'amount': total,
+                        'error': 'Användaren har inte angett alla sina bankuppgifter',
+                    })
+                else:
+                    payments.append(Payment(payer=payer, receiver=owner, account=account, total=total))
+            payments = Payment.objects.bulk_create(payments)
+
+            paid = {payment.receiver_id: payment for payment in payments}
+            paid_expenses = [expense for expense in expenses if expense.owner_id in paid]
+            if paid_expenses:
+                Expense.objects.filter(pk__in=[expense.id for expense in paid_expenses]).update(reimbursement=Case(
+                    *[When(owner_id=owner_id, then=Value(payment.id)) for owner_id, payment in paid.items()],
+                    output_field=IntegerField()
+                ))
+                Expense.update_states([expense.id for expense in paid_expenses])
+                expenses_reimbursed.send(sender=Payment, expense_ids=[expense.id for expense in paid_expenses])
+                Comment.bulk_create_and_notify([Comment(
+                    author=payer,
+                    expense=expense,
+                    content="Betalade ut i betalning " + str(paid[expense.owner_id].id)
+                ) for expense in paid_expenses])
+
+        return {
+            'payments': [dict(payment.to_dict(), expenses=[
+                expense.id for expense in by_owner[payment.receiver_id]
+            ]) for payment in payments],
+            'skipped': skipped,
+            'total': sum(payment.total for payment in payments),
+        }
+
+
+# Returns the series and sequence number of a verification like "E214", or ('', None) if it doesn't have that form
+def split_verification(verification):
+    match = re.match(r'^([A-Za-z]*)([0-9]+)$', verification.strip())
+    if match is None:
+        return '', None
+    return match.group(1).upper(), int(match.group(2))
+
+
+# Returns the accounting year of a verification with the sequence number, booked on day, or None if it has no number.
+# The day is a string until the expense or invoice has been loaded from the database.
+def verification_year(number, day):
+    if number is None or not day:
+        return None
+    return int(str(day)[:4])
+
+
+# Returns the keyword arguments for saving instance without writing its total, which is only written by update_totals
+# so that a stale instance can't overwrite the sum of the parts
+def without_total(instance, kwargs):
+    if instance.pk is None or kwargs.get('force_insert'):
+        return kwargs
+    if instance._state.adding and not type(instance).objects.filter(pk=instance.pk).exists():
+        return kwargs
+    fields = kwargs.get('update_fields')
+    if fields is None:
+        fields = [field.name for field in instance._meta.concrete_fields if not field.primary_key]
+    return dict(kwargs, update_fields=[name for name in fields if name != 'total'])
+
 
 class Expense(models.Model):
     """
@@ -265,14 +367,74 @@ class Expense(models.Model):
     about the expense.
     """
     created_date = models.DateField(auto_now_add=True)
-    expense_date = models.DateField()
+    expense_date = models.DateField(db_index=True)
     confirmed_by = models.ForeignKey(User, blank=True, null=True)
     confirmed_at = models.DateField(blank=True, null=True, default=None)
     owner = models.ForeignKey(Profile)
     description = models.TextField()
     reimbursement = models.ForeignKey(Payment, blank=True, null=True)
-    verification = models.CharField(max_length=7, blank=True)
+    verification = models.CharField(max_length=7, blank=True, db_index=True)
+    # The verification split by split_verification, and its accounting year, the year of the expense date. Kept up to
+    # date by save() and bulk_set_verification.
+    verification_series = models.CharField(max_length=7, blank=True, editable=False)
+    verification_year = models.SmallIntegerField(null=True, blank=True, editable=False)
+    verification_number = models.IntegerField(null=True, blank=True, editable=False)
     is_digital = models.NullBooleanField()
+    # Sum of the expense parts, kept up to date by Expense.update_totals
+    total = models.DecimalField(max_digits=11, decimal_places=2, default=0, editable=False, db_index=True)
+
+    # Where the expense is in the workflow, kept up to date by save() and Expense.update_states.
+    # The queues are read through partial indexes on this field, see migration 0026.
+    UNATTESTED = 'unattested'
+    ATTESTED = 'attested'
+    PAYABLE = 'payable'
+    PAID = 'paid'
+    ACCOUNTED = 'accounted'
+    STATES = (
+        (UNATTESTED, 'Inte attesterad'),
+        (ATTESTED, 'Attesterad men inte bekräftad av kassör'),
+        (PAYABLE, 'Inväntar utbetalning'),
+        (PAID, 'Utbetald'),
+        (ACCOUNTED, 'Bokförd'),
+    )
+    state = models.CharField(max_length=10, choices=STATES, default=UNATTESTED, editable=False)
+    # The queue that an expense in each state is listed in, besides the confirm queue
+    STATE_QUEUES = {UNATTESTED: 'attest', PAYABLE: 'pay', PAID: 'account'}
+    # The description and comments for full-text search, kept up to date by Expense.update_search_vectors
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    # Remember which payment and description the expense had when loaded, see save()
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        expense = super().from_db(db, field_names, values)
+        expense._loaded_reimbursement_id = expense.__dict__.get('reimbursement_id')
+        expense._loaded_description = expense.__dict__.get('description')
+        expense._loaded_expense_date = expense.__dict__.get('expense_date')
+        expense._loaded_queues = Expense.queue_names(expense.__dict__.get('state'), expense.__dict__.get('confirmed_by_id'))
+        return expense
+
+    def save(self, *args, **kwargs):
+        self.state = self.current_state()
+        self.verification_series, self.verification_number = split_verification(self.verification)
+        self.verification_year = verification_year(self.verification_number, self.expense_date)
+        with transaction.atomic():
+            if self.pk is not None and not hasattr(self, '_loaded_expense_date'):
+                # Not loaded from the database, so compare with what is stored
+                stored = Expense.objects.filter(pk=self.pk).first()
+                if stored is not None:
+                    self.__dict__.update({name: value for name, value in stored.__dict__.items()
+                                          if name.startswith('_loaded_')})
+            super().save(*args, **without_total(self, kwargs))
+            payment_ids = {self.reimbursement_id, getattr(self, '_loaded_reimbursement_id', None)} - {None}
+            if payment_ids:
+                Payment.update_totals(payment_ids)
+            if self.description != getattr(self, '_loaded_description', None):
+                Expense.update_search_vectors([self.pk])
+            queues.bump(*(getattr(self, '_loaded_queues', set()) | Expense.queue_names(self.state, self.confirmed_by_id)))
+            self._loaded_reimbursement_id = self.reimbursement_id
+            self._loaded_description = self.description
+            self._loaded_expense_date = self.expense_date
+            self._loaded_queues = Expense.queue_names(self.state, self.confirmed_by_id)
 
     # Returns a string representation of the expense
     def __str__(self):
@@ -287,75 +449,336 @@ class Expense(models.Model):
         return str(self.to_dict())
 
     def status(self):
-        if self.verification:
+        if self.state == Expense.ACCOUNTED:
             return "Bokförd som " + str(self.verification)
-        if self.reimbursement:
-            return "Utbetald"
-        if self.is_attested() and self.confirmed_by:
-            return "Inväntar utbetalning"
-        if self.is_attested() and not self.confirmed_by:
-            return "Attesterad men inte bekräftad av kassör"
-        if not self.is_attested() and self.confirmed_by:
+        if self.state == Expense.UNATTESTED and self.confirmed_by_id is not None:
             return "Inte attesterad men bekräftad av kassör"
-        return "Inte attesterad"
+        return self.get_state_display()
+
+    # Returns the state the expense should be in, from its fields and parts
+    def current_state(self):
+        if self.verification:
+            return Expense.ACCOUNTED
+        if self.reimbursement_id is not None:
+            return Expense.PAID
+        # An expense without parts has nothing attested yet
+        if self.pk is None or not self.expensepart_set.exists() or \
+                self.expensepart_set.filter(attested_by=None).exists():
+            return Expense.UNATTESTED
+        if self.confirmed_by_id is not None:
+            return Expense.PAYABLE
+        return Expense.ATTESTED
+
+    # Returns the names of the queues, see expenses/queues.py, that an expense with the given state and confirmer is in
+    @staticmethod
+    def queue_names(state, confirmed_by_id):
+        names = {Expense.STATE_QUEUES[state]} if state in Expense.STATE_QUEUES else set()
+        if confirmed_by_id is None:
+            names.add('confirm')
+        return names
+
+    # Recomputes the stored state of the given expenses, the same way as current_state, and bumps the queues they
+    # were or are in
+    @staticmethod
+    def update_states(expense_ids):
+        expenses = Expense.objects.filter(pk__in=expense_ids)
+        changed = set()
+        for state, confirmed_by_id in expenses.values_list('state', 'confirmed_by_id'):
+            changed |= Expense.queue_names(state, confirmed_by_id)
+
+        parts = ExpensePart.objects.filter(expense__in=expense_ids).values('expense')
+        unattested = ExpensePart.objects.filter(expense__in=expense_ids, attested_by=None).values('expense')
+        expenses.update(state=Case(
+            When(~Q(verification=''), then=Value(Expense.ACCOUNTED)),
+            When(reimbursement__isnull=False, then=Value(Expense.PAID)),
+            When(Q(pk__in=unattested) | ~Q(pk__in=parts), then=Value(Expense.UNATTESTED)),
+            When(confirmed_by__isnull=False, then=Value(Expense.PAYABLE)),
+            default=Value(Expense.ATTESTED),
+            output_field=models.CharField(),
+        ))
+        for state, confirmed_by_id in expenses.values_list('state', 'confirmed_by_id'):
+            changed |= Expense.queue_names(state, confirmed_by_id)
+        queues.bump(*changed)
+
+    # Confirms the expenses, like the confirm view does for one expense, with one update for all expenses.
+    # Returns the confirm comments unsaved, to be saved with Comment.bulk_create_and_notify.
+    @staticmethod
+    def bulk_confirm(expenses, user):
+        Expense.objects.filter(pk__in=[expense.pk for expense in expenses]).update(
+            confirmed_by=user,
+            confirmed_at=date.today()
+        )
+        Expense.update_states([expense.pk for expense in expenses])
+        return [Comment(
+            expense=expense,
+            author=user.profile,
+            content='Jag har bekräftat kvittots giltighet.'
+        ) for expense in expenses]
+
+    # Removes the confirmation of the expenses with one update for all expenses.
+    # Returns the unconfirm comments unsaved, to be saved with Comment.bulk_create_and_notify.
+    @staticmethod
+    def bulk_unconfirm(expenses, user):
+        Expense.objects.filter(pk__in=[expense.pk for expense in expenses]).update(
+            confirmed_by=None,
+            confirmed_at=None
+        )
+        Expense.update_states([expense.pk for expense in expenses])
+        return [Comment(
+            expense=expense,
+            author=user.profile,
+            content='Jag tar bort bekräftelsen av kvittots giltighet.'
+        ) for expense in expenses]
+
+    # Sets the verification numbers in verifications, a list of (expense, verification), with one update per batch of
+    # expenses. Returns the account comments unsaved, to be saved with Comment.bulk_create_and_notify.
+    @staticmethod
+    def bulk_set_verification(verifications, user, batch_size=500):
+        for start in range(0, len(verifications), batch_size):
+            batch = verifications[start:start + batch_size]
+            split = {expense.pk: split_verification(verification) for expense, verification in batch}
+            Expense.objects.filter(pk__in=split.keys()).update(
+                verification=Case(
+                    *[When(pk=expense.pk, then=Value(verification)) for expense, verification in batch],
+                    output_field=TextField()
+                ),
+                verification_series=Case(
+                    *[When(pk=pk, then=Value(series)) for pk, (series, _) in split.items()],
+                    output_field=TextField()
+                ),
+                verification_number=Case(
+                    *[When(pk=pk, then=Value(number)) for pk, (_, number) in split.items()],
+                    output_field=IntegerField()
+                ),
+                verification_year=Case(
+                    *[When(pk=expense.pk, then=Value(verification_year(split[expense.pk][1], expense.expense_date)))
+                      for expense, _ in batch],
+                    output_field=IntegerField()
+                ),
+            )
+        Expense.update_states([expense.pk for expense, _ in verifications])
+        return [Comment(
+            expense=expense,
+            author=user.profile,
+            content="Bokförde med verifikationsnumret: " + verification
+        ) for expense, verification in verifications]
 
     # Return the total amount of the expense parts
     def total_amount(self):
-        total = 0
-        for part in self.expensepart_set.all():
-            total += part.amount
-        return total
+        return self.total
+
+    # Recomputes the stored total of the given expenses and of the payments they belong to
+    @staticmethod
+    def update_totals(expense_ids):
+        part_totals = ExpensePart.objects.filter(expense=OuterRef('pk')).order_by() \
+            .values('expense').annotate(sum=Sum('amount')).values('sum')
+        Expense.objects.filter(pk__in=expense_ids).update(
+            total=Coalesce(Subquery(part_totals, output_field=DecimalField()), 0)
+        )
+        payment_ids = Expense.objects.filter(pk__in=expense_ids, reimbursement__isnull=False) \
+            .values_list('reimbursement', flat=True)
+        if payment_ids:
+            Payment.update_totals(list(payment_ids))
 
     # Returns the cost_centres belonging to the expense as a list [{ cost_centres: 'Name' }, ...]
+    # Reads the parts through the prefetch cache when they were loaded with with_related
     def cost_centres(self):
-        return self.expensepart_set.order_by('cost_centre').values('cost_centre').distinct()
+        return [{'cost_centre': cost_centre}
+                for cost_centre in sorted({part.cost_centre for part in self.expensepart_set.all()})]
 
     def is_attested(self):
-        return self.expensepart_set.filter(attested_by__isnull=True).count() == 0
+        return not self.expensepart_set.filter(attested_by__isnull=True).exists()
 
     # Returns a dict representation of the model
     def to_dict(self):
         exp = model_to_dict(self)
-        exp['expense_parts'] = [part.to_dict() for part in ExpensePart.objects.filter(expense=self)]
+        parts = self.expensepart_set.all()
+        exp['expense_parts'] = [part.to_dict() for part in parts]
         exp['owner_username'] = self.owner.user.username
         exp['owner_first_name'] = self.owner.user.first_name
         exp['owner_last_name'] = self.owner.user.last_name
-        exp['amount'] = self.total_amount()
+        exp['amount'] = self.total
         exp['cost_centres'] = [cost_centre['cost_centre'] for cost_centre in self.cost_centres()]
         if self.reimbursement is not None:
             exp['reimbursement'] = self.reimbursement.to_dict()
         return exp
 
+    # Returns the expenses with everything that to_dict uses fetched in a constant number of queries
+    @staticmethod
+    def with_related(expenses):
+        return expenses.select_related(
+            'owner__user',
+            'reimbursement__payer__user',
+            'reimbursement__receiver__user',
+            'reimbursement__account',
+        ).prefetch_related(Prefetch(
+            'expensepart_set',
+            queryset=ExpensePart.objects.select_related('attested_by__user').order_by('id')
+        ))
+
+    # Returns a list of dict representations of the expenses
+    @staticmethod
+    def bulk_to_dict(expenses):
+        return [expense.to_dict() for expense in Expense.with_related(expenses)]
+
+    # Returns the expenses as lightweight rows for the queue endpoints, see add_parts
+    @staticmethod
+    def queue_rows(expenses):
+        return expenses.values(
+            'id', 'description', 'expense_date', 'created_date', 'verification', 'is_digital',
+            amount=F('total'),
+            owner_username=F('owner__user__username'),
+            owner_first_name=F('owner__user__first_name'),
+            owner_last_name=F('owner__user__last_name'),
+        )
+
+    # Adds the parts and cost centres to rows from queue_rows, in one query
+    @staticmethod
+    def add_parts(rows):
+        parts = {}
+        for part in ExpensePart.objects.filter(expense_id__in=[row['id'] for row in rows]).order_by('id').values(
+                'id', 'expense_id', 'cost_centre', 'secondary_cost_centre', 'budget_line', 'amount', 'attested_by'):
+            parts.setdefault(part.pop('expense_id'), []).append(part)
+        for row in rows:
+            row['parts'] = parts.get(row['id'], [])
+            row['cost_centres'] = sorted({part['cost_centre'] for part in row['parts']})
+        return rows
+
+    # Recomputes the full-text search vector of the given expenses from their description and comments
+    @staticmethod
+    def update_search_vectors(expense_ids):
+        comments = Comment.objects.filter(expense=OuterRef('pk')).order_by().values('expense') \
+            .annotate(text=StringAgg('content', ' ')).values('text')
+        Expense.objects.filter(pk__in=expense_ids).update(
+            search_vector=SearchVector('description', config='swedish', weight='A') +
+            SearchVector(Subquery(comments, output_field=TextField()), config='swedish', weight='B')
+        )
+
+    # Returns the expenses matching the full-text query, best match first. score is the rank as an integer,
+    # so that it can be used in a pagination cursor.
+    @staticmethod
+    def search(query):
+        query = SearchQuery(query, config='swedish')
+        return Expense.objects.filter(search_vector=query).annotate(
+            score=Cast(SearchRank(F('search_vector'), query) * Value(1000000, output_field=FloatField()), IntegerField())
+        ).order_by('-score', '-id')
+
+    # Returns the expenses of year that are accounted in series, by sequence number
+    @staticmethod
+    def verification_sequence(series, year):
+        return Expense.objects \
+            .filter(verification_series=series, verification_year=year, verification_number__isnull=False) \
+            .order_by('verification_number', 'id')
+
+    # Returns the sequence numbers used in series in year in increasing order, by expenses and by invoices, which
+    # share the series
+    @staticmethod
+    def verification_numbers(series, year):
+        expenses = Expense.verification_sequence(series, year).order_by().values_list('verification_number', flat=True)
+        invoices = Invoice.verification_sequence(series, year).order_by().values_list('verification_number', flat=True)
+        return expenses.union(invoices).order_by('verification_number')
+
+    # Returns the sequence numbers that are missing in series in year, as a list of (first, last) ranges, up to the
+    # highest number used
+    @staticmethod
+    def verification_gaps(series, year):
+        gaps = []
+        previous = 0
+        for number in Expense.verification_numbers(series, year):
+            if number > previous + 1:
+                gaps.append((previous + 1, number - 1))
+            previous = number
+        return gaps
+
+    # Returns the first sequence number after the highest one used in series in year, by an expense or an invoice
+    @staticmethod
+    def next_verification_number(series, year):
+        last = [
+            Expense.verification_sequence(series, year).aggregate(last=Max('verification_number'))['last'],
+            Invoice.verification_sequence(series, year).aggregate(last=Max('verification_number'))['last'],
+        ]
+        return max(filter(None, last), default=0) + 1
+
+    # Returns the expenses whose verification matches query, prefix matches first and then by similarity
+    @staticmethod
+    def search_verification(query):
+        matches = Q(verification__contains=query)
+        if len(query) >= 3:
+            # Shorter queries have no trigrams to compare, so they only match as substrings
+            matches |= Q(verification__trigram_similar=query)
+        return Expense.objects.filter(matches).annotate(
+            prefix=Case(
+                When(verification__startswith=query, then=Value(1)),
+                default=Value(0),
+                output_field=models.IntegerField()
+            ),
+            similarity=TrigramSimilarity('verification', query),
+        ).order_by('-prefix', '-similarity', 'verification')
+
     @staticmethod
     def view_attestable(may_attest, user):
-        filters = {
-            'expensepart__attested_by': None,
-        }
-        if 'firmatecknare' not in may_attest:
-            filters['expensepart__cost_centre__iregex'] = r'(' + '|'.join(may_attest) + ')'
-        return Expense.objects.order_by('-id', '-expense_date').filter(**filters).distinct()
+        expenses = Expense.objects.filter(state=Expense.UNATTESTED)
+        if 'firmatecknare' not in may_attest and '*' not in may_attest:
+            expenses = expenses.filter(pk__in=ExpensePart.objects.filter(
+                attested_by=None,
+                cost_centre_key__in=may_attest
+            ).values('expense'))
+        return expenses.order_by('-id', '-expense_date')
 
     @staticmethod
     def confirmable():
-        return Expense.objects.filter(confirmed_by__isnull=True).distinct()
+        return Expense.objects.filter(confirmed_by__isnull=True)
 
     @staticmethod
     def payable():
-        return Expense.objects. \
-            filter(reimbursement=None). \
-            exclude(expensepart__attested_by=None). \
-            exclude(confirmed_by=None). \
-            order_by('owner__user__username')
+        return Expense.objects.filter(state=Expense.PAYABLE).order_by('owner__user__username')
 
     @staticmethod
     def view_accountable(may_account):
-        if '*' in may_account:
-            return Expense.objects.exclude(reimbursement=None).filter(verification='').distinct().order_by(
-                'expense_date')
-        return Expense.objects.exclude(reimbursement=None).filter(
-            verification='',
-            expensepart__cost_centre__iregex=r'(' + '|'.join(may_account) + ')'
-        ).distinct().order_by('expense_date')
+        expenses = Expense.objects.filter(state=Expense.PAID)
+        if '*' not in may_account:
+            expenses = expenses.filter(pk__in=ExpensePart.objects.filter(
+                cost_centre_key__in=may_account
+            ).values('expense'))
+        return expenses.order_by('expense_date')
+
+    # Returns the number of expenses in each queue that a user with the given permissions may view, in one query.
+    # The permissions are those returned by Profile.may_view_attest and friends, a queue with no permission counts 0.
+    @staticmethod
+    def queue_counts(may_attest, may_confirm, may_pay, may_account):
+        conditions = {}
+        if may_attest:
+            conditions['attest'] = Q(state=Expense.UNATTESTED)
+            if 'firmatecknare' not in may_attest and '*' not in may_attest:
+                conditions['attest'] &= Q(pk__in=ExpensePart.objects.filter(
+                    attested_by=None,
+                    cost_centre_key__in=may_attest
+                ).values('expense'))
+        if may_confirm:
+            conditions['confirm'] = Q(confirmed_by__isnull=True)
+        if may_pay:
+            conditions['pay'] = Q(state=Expense.PAYABLE)
+        if may_account:
+            conditions['account'] = Q(state=Expense.PAID)
+            if '*' not in may_account:
+                conditions['account'] &= Q(pk__in=ExpensePart.objects.filter(
+                    cost_centre_key__in=may_account
+                ).values('expense'))
+
+        counts = {'attest': 0, 'confirm': 0, 'pay': 0, 'account': 0}
+        if conditions:
+            counts.update(Expense.objects.filter(reduce(operator.or_, conditions.values())).aggregate(**{
+                name: Sum(Case(When(condition, then=Value(1)), default=Value(0), output_field=IntegerField()))
+                for name, condition in conditions.items()
+            }))
+        return {name: count or 0 for name, count in counts.items()}
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector'], name='expense_search_vector_idx'),
+            models.Index(fields=['verification_series', 'verification_year', 'verification_number'],
+                         name='expense_verification_seq_idx'),
+        ]
 
 
 class File(models.Model):
@@ -396,6 +819,8 @@ class ExpensePart(models.Model):
     """
     expense = models.ForeignKey(Expense, on_delete=models.CASCADE)
     cost_centre = models.TextField(blank=True)
+    # The cost centre normalized with dauth.cost_centre_key, used to match it against permissions
+    cost_centre_key = models.TextField(blank=True, editable=False, db_index=True)
     secondary_cost_centre = models.TextField(blank=True)
     budget_line = models.TextField(blank=True)
     amount = models.DecimalField(max_digits=9, decimal_places=2)
@@ -406,6 +831,36 @@ class ExpensePart(models.Model):
     def __str__(self):
         return self.expense.__str__() + " (" + self.budget_line + ": " + str(self.amount) + " kr)"
 
+    # Remember which expense, budget fields and amount the part had when loaded, see save() and stats/models.py
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        part = super().from_db(db, field_names, values)
+        part.remember_loaded()
+        return part
+
+    def remember_loaded(self):
+        self._loaded_expense_id = self.__dict__.get('expense_id')
+        self._loaded_budget = tuple(self.__dict__.get(field)
+                                    for field in ('cost_centre', 'secondary_cost_centre', 'budget_line'))
+        self._loaded_amount = self.__dict__.get('amount')
+
+    def save(self, *args, **kwargs):
+        self.cost_centre_key = dauth.cost_centre_key(self.cost_centre)
+        # The forms and the API give the amount as a string or a float, the rollup adds it to decimals
+        self.amount = self._meta.get_field('amount').to_python(self.amount)
+        with transaction.atomic():
+            if self.pk is not None and not hasattr(self, '_loaded_expense_id'):
+                # Not loaded from the database, so compare with what is stored
+                stored = ExpensePart.objects.filter(pk=self.pk).first()
+                if stored is not None:
+                    self._loaded_expense_id = stored._loaded_expense_id
+                    self._loaded_budget = stored._loaded_budget
+                    self._loaded_amount = stored._loaded_amount
+            super().save(*args, **kwargs)
+            Expense.update_totals([self.expense_id])
+            Expense.update_states([self.expense_id])
+            self.remember_loaded()
+
     # Returns unicode representation of the model
     def __unicode__(self):
         return self.expense.__unicode__() + " (" + self.budget_line + ": " + str(self.amount) + " kr)"
@@ -422,6 +877,21 @@ class ExpensePart(models.Model):
         )
         comment.save()
 
+    # Attests the parts like attest, with one update for all parts. The parts must have their expense loaded and not be
+    # attested. Returns the attest comments unsaved, to be saved with Comment.bulk_create_and_notify.
+    @staticmethod
+    def bulk_attest(parts, user):
+        ExpensePart.objects.filter(pk__in=[part.pk for part in parts]).update(
+            attested_by=user.profile,
+            attest_date=date.today()
+        )
+        Expense.update_states({part.expense_id for part in parts})
+        return [Comment(
+            author=user.profile,
+            expense=part.expense,
+            content="Attesterar kvittodelen ```" + str(part) + "```"
+        ) for part in parts]
+
     def unattest(self, user):
         self.attested_by = None
         self.attest_date = None
@@ -446,6 +916,13 @@ class ExpensePart(models.Model):
             exp_part['attested_by_last_name'] = self.attested_by.user.last_name
         return exp_part
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['expense', 'attested_by'], name='expensepart_attest_idx'),
+            models.Index(fields=['cost_centre', 'secondary_cost_centre', 'budget_line'],
+                         name='expensepart_cost_centre_idx'),
+        ]
+
 
 class Comment(models.Model):
     """
@@ -474,8 +951,73 @@ class Comment(models.Model):
         comment['author_last_name'] = self.author.user.last_name
         return comment
 
+    # Saves comments by one author in one query and sends each owner one email with all comments on their expenses
+    # and invoices, instead of one email per comment like send_mail. The emails are sent when the transaction commits.
+    @staticmethod
+    def bulk_create_and_notify(comments):
+        comments = Comment.objects.bulk_create(comments)
+        Expense.update_search_vectors({comment.expense_id for comment in comments} - {None})
+        Invoice.update_search_vectors({comment.invoice_id for comment in comments} - {None})
+
+        by_owner = {}
+        for comment in comments:
+            owner = comment.expense.owner if comment.expense else comment.invoice.owner
+            if owner != comment.author:
+                by_owner.setdefault(owner, []).append(comment)
+
+        def notify():
+            for owner, owner_comments in by_owner.items():
+                author = owner_comments[0].author
+                subject = str(author) + ' har kommenterat dina utlägg och fakturor.'
+                content = render_to_string('comments_email.html', {
+                    'comments': owner_comments,
+                    'author': author,
+                    'receiver': owner,
+                })
+                email.send_mail(owner.user.email, subject, content)
+
+        transaction.on_commit(notify)
+        return comments
+
     class Meta:
         ordering = ['date']
+        indexes = [
+            models.Index(fields=['expense', 'date'], name='comment_expense_date_idx'),
+            models.Index(fields=['invoice', 'date'], name='comment_invoice_date_idx'),
+        ]
+
+
+# Deleting parts, also through querysets and cascades, changes the totals and states. Runs in the deleting transaction.
+# noinspection PyUnusedLocal
+@receiver(post_delete, sender=ExpensePart)
+def update_expense_total(sender, instance, **kwargs):
+    Expense.update_totals([instance.expense_id])
+    Expense.update_states([instance.expense_id])
+
+
+# noinspection PyUnusedLocal
+@receiver(post_delete, sender=Expense)
+def update_payment_total(sender, instance, **kwargs):
+    if instance.reimbursement_id is not None:
+        Payment.update_totals([instance.reimbursement_id])
+
+
+# Anything cached from the queues that the expense was in is outdated when it is deleted, save() handles changes
+# noinspection PyUnusedLocal
+@receiver(post_delete, sender=Expense)
+def bump_expense_queues(sender, instance, **kwargs):
+    queues.bump(*Expense.queue_names(instance.state, instance.confirmed_by_id))
+
+
+# Comments are part of the full-text search vector of their expense or invoice
+# noinspection PyUnusedLocal
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def update_search_vector(sender, instance, **kwargs):
+    if instance.expense_id is not None:
+        Expense.update_search_vectors([instance.expense_id])
+    if instance.invoice_id is not None:
+        Invoice.update_search_vectors([instance.invoice_id])
 
 
 # Sends mail on comment
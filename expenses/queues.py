@@ -0,0 +1,58 @@
+"""
+Change versions of the attest, confirm, pay and account queues.
+
+Everything that is cached from a queue is stored under a key or ETag that
+includes its version, so bumping the version invalidates all of it at once.
+A version is the time of the last change of the queue in milliseconds.
+"""
+
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+QUEUES = ('attest', 'confirm', 'pay', 'account')
+
+
+def _key(name):
+    return 'queue-version:' + name
+
+
+def _now():
+    return int(time.time() * 1000)
+
+
+def versions(*names):
+    """
+    Returns a dict with the current version of each of the named queues, or of all queues if no names are given.
+    """
+    names = names or QUEUES
+    found = cache.get_many([_key(name) for name in names])
+    missing = {_key(name): _now() for name in names if _key(name) not in found}
+    if missing:
+        cache.set_many(missing, None)
+        found.update(missing)
+    return {name: found[_key(name)] for name in names}
+
+
+def version(*names):
+    """
+    Returns the version of the most recently changed of the named queues, or of all queues if no names are given.
+    """
+    return max(versions(*names).values())
+
+
+def bump(*names):
+    """
+    Marks the named queues as changed. Called whenever an expense or invoice in them is saved or deleted, or when
+    states are recomputed. The versions change when the transaction commits, so that nothing read before the commit
+    is cached under the new versions.
+    """
+    if not names:
+        return
+
+    def commit():
+        now = _now()
+        cache.set_many({_key(name): max(now, current + 1) for name, current in versions(*names).items()}, None)
+
+    transaction.on_commit(commit)
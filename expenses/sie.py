@@ -0,0 +1,154 @@
+"""
+SIE4 export of the bookkeeping of a year, so that it can be imported into the accounting program.
+
+Every reimbursed expense and paid invoice becomes a verification, with one
+transaction per part on SIE_COST_ACCOUNT and one for the total on
+SIE_BANK_ACCOUNT. Cost centres, secondary cost centres and budget lines are
+exported as objects in dimensions 1, 2 and 20.
+
+The parts are read through server-side cursors and the file is generated line
+by line, so a year is never held in memory. The same data always gives the
+same file, and the file ends with the CRC-32 checksum (#KSUMMA) of the format.
+"""
+
+import zlib
+from datetime import date
+from itertools import groupby
+
+from django.conf import settings
+from django.db.models import F, Max
+
+from expenses.models import ExpensePart
+from invoices.models import InvoicePart
+
+# SIE uses the IBM PC code page
+ENCODING = 'cp437'
+
+# The dimensions that the part fields are exported as
+DIMENSIONS = [
+    (1, 'cost_centre', 'Resultatställe'),
+    (2, 'secondary_cost_centre', 'Sekundärt resultatställe'),
+    (20, 'budget_line', 'Budgetpost'),
+]
+
+def _quote(value):
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _field(value):
+    """
+    Returns a field as written to the file and its content as included in the checksum.
+    """
+    if isinstance(value, list):
+        return (
+            '{' + ' '.join(str(dimension) + ' ' + _quote(key) for dimension, key in value) + '}',
+            ''.join(str(dimension) + key for dimension, key in value),
+        )
+    if isinstance(value, date):
+        value = value.strftime('%Y%m%d')
+        return value, value
+    if isinstance(value, str):
+        value = ' '.join(value.split())
+        return _quote(value), value
+    if isinstance(value, int):
+        return str(value), str(value)
+    return '%.2f' % value, '%.2f' % value
+
+
+class _Writer(object):
+    """
+    Encodes records and keeps the checksum of everything encoded since the checksum was started.
+    """
+
+    def __init__(self):
+        self.checksum = None
+
+    def record(self, label, *fields, indent=''):
+        fields = [_field(field) for field in fields]
+        if self.checksum is not None:
+            content = label + ''.join(checksummed for _, checksummed in fields)
+            self.checksum = zlib.crc32(content.encode(ENCODING, 'replace'), self.checksum)
+        return (indent + ' '.join([label] + [written for written, _ in fields]) + '\r\n').encode(ENCODING, 'replace')
+
+    def line(self, text):
+        return (text + '\r\n').encode(ENCODING)
+
+
+def _verifications(writer, parts, key, text):
+    for _, rows in groupby(parts, key=lambda part: part[key + '_id']):
+        rows = list(rows)
+        first = rows[0]
+        # Verifications that are not like "E123" are left for the accounting program to number
+        series, number = first[key + '__verification_series'], first[key + '__verification_number']
+        description = text + ' ' + str(first[key + '_id'])
+        if number is None:
+            series, number = '', ''
+            if first[key + '__verification']:
+                description += ' ' + first[key + '__verification']
+        description += ': ' + first[key + '__description']
+
+        yield writer.record('#VER', series, number, first['date'], description)
+        yield writer.line('{')
+        for row in rows:
+            objects = [(dimension, row[field]) for dimension, field, _ in DIMENSIONS if row[field]]
+            yield writer.record('#TRANS', settings.SIE_COST_ACCOUNT, objects, row['amount'], indent='   ')
+        yield writer.record('#TRANS', settings.SIE_BANK_ACCOUNT, [], -sum(row['amount'] for row in rows), indent='   ')
+        yield writer.line('}')
+
+
+def export(year):
+    """
+    Yields the lines of the SIE4 file for year, encoded.
+    """
+    expense_parts = ExpensePart.objects \
+        .filter(expense__expense_date__year=year, expense__reimbursement__isnull=False) \
+        .order_by('expense__expense_date', 'expense_id', 'id')
+    invoice_parts = InvoicePart.objects \
+        .filter(invoice__payed_at__year=year) \
+        .order_by('invoice__payed_at', 'invoice_id', 'id')
+
+    # The file is dated by its newest verification instead of by today, so that it is reproducible
+    generated = max(filter(None, [
+        expense_parts.aggregate(date=Max('expense__expense_date'))['date'],
+        invoice_parts.aggregate(date=Max('invoice__payed_at'))['date'],
+    ]), default=date(year, 1, 1))
+
+    objects = {field: set() for _, field, _ in DIMENSIONS}
+    fields = [field for _, field, _ in DIMENSIONS]
+    for queryset in [expense_parts, invoice_parts]:
+        for row in queryset.order_by().values(*fields).distinct():
+            for field in fields:
+                if row[field]:
+                    objects[field].add(row[field])
+
+    writer = _Writer()
+    yield writer.record('#FLAGGA', 0)
+    yield writer.record('#KSUMMA')
+    writer.checksum = 0
+    yield writer.record('#PROGRAM', 'Cashflow', '1.0')
+    yield writer.record('#FORMAT', 'PC8')
+    yield writer.record('#GEN', generated)
+    yield writer.record('#SIETYP', 4)
+    yield writer.record('#FNAMN', settings.SIE_COMPANY_NAME)
+    yield writer.record('#RAR', 0, date(year, 1, 1), date(year, 12, 31))
+    yield writer.record('#KONTO', settings.SIE_BANK_ACCOUNT, 'Bank')
+    yield writer.record('#KONTO', settings.SIE_COST_ACCOUNT, 'Kostnader')
+    for dimension, field, name in DIMENSIONS:
+        yield writer.record('#DIM', dimension, name)
+        for key in sorted(objects[field]):
+            yield writer.record('#OBJEKT', dimension, key, key)
+
+    yield from _verifications(writer, expense_parts.values(
+        'expense_id', 'expense__verification', 'expense__verification_series', 'expense__verification_number',
+        'expense__description', 'amount', *fields,
+        date=F('expense__expense_date'),
+    ).iterator(), 'expense', 'Utlägg')
+    yield from _verifications(writer, invoice_parts.values(
+        'invoice_id', 'invoice__verification', 'invoice__verification_series', 'invoice__verification_number',
+        'invoice__description', 'amount', *fields,
+        date=F('invoice__payed_at'),
+    ).iterator(), 'invoice', 'Faktura')
+
+    checksum = writer.checksum
+    writer.checksum = None
+    yield writer.record('#KSUMMA', checksum)
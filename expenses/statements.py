@@ -0,0 +1,221 @@
+"""
+Bank statement import, to check that payments actually left the account.
+
+Statements are read as a stream of transactions, from ISO 20022 camt.053 XML or
+from CSV. Outgoing transactions are matched to payments by the payment tag
+("Data<id>") in their message and by amount. The payments are looked up in
+batches into a dict, so a statement costs a few queries however long it is.
+"""
+
+import codecs
+import csv
+import re
+from collections import namedtuple
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from xml.etree.ElementTree import ParseError, iterparse
+
+from django.db import transaction
+
+from expenses.models import Payment
+
+# A transaction in a statement. Rows that could not be read have only the text and the reason in error.
+Transaction = namedtuple('Transaction', ['date', 'amount', 'text', 'error'])
+Transaction.__new__.__defaults__ = (None,)
+
+# The columns that a CSV statement must have
+CSV_COLUMNS = ('Datum', 'Meddelande', 'Belopp')
+
+TAG_PATTERN = re.compile(r'data\s*(\d+)', re.IGNORECASE)
+
+# Number of transactions whose payments are looked up with one query
+BATCH_SIZE = 1000
+
+# Elements of a camt.053 entry that can hold the message of the transfer
+TEXT_ELEMENTS = ('EndToEndId', 'Ustrd', 'Ref', 'AddtlTxInf', 'AddtlNtryInf')
+
+
+class StatementError(Exception):
+    """
+    Raised by the readers for files that are not statements in the expected format.
+    """
+
+
+def _local(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _children(element, name):
+    return [child for child in element.iter() if _local(child.tag) == name]
+
+
+def _child(element, *paths):
+    # Returns the first element found at any of the paths, Element itself is falsy when it has no children
+    for path in paths:
+        found = element
+        for name in path:
+            found = next((child for child in found if _local(child.tag) == name), None)
+            if found is None:
+                break
+        if found is not None:
+            return found
+    return None
+
+
+def _text(element):
+    return ' '.join(child.text.strip() for child in element.iter()
+                    if _local(child.tag) in TEXT_ELEMENTS and child.text)
+
+
+def _value(element, *paths):
+    found = _child(element, *paths)
+    return found.text.strip() if found is not None and found.text else None
+
+
+def _camt053_entry(entry):
+    # Returns the transactions of a booked outgoing entry that isn't a reversal
+    if _value(entry, ['CdtDbtInd']) != 'DBIT':
+        return []
+    # Pending entries haven't left the account yet, and reversed entries have come back to it
+    if _value(entry, ['Sts', 'Cd'], ['Sts']) not in (None, 'BOOK') or _value(entry, ['RvslInd']) in ('true', '1'):
+        return []
+
+    booked = _value(entry, ['BookgDt', 'Dt'], ['BookgDt', 'DtTm'], ['ValDt', 'Dt'], ['ValDt', 'DtTm'])
+    if booked is None:
+        raise StatementError('an entry has no booking date')
+    try:
+        date = datetime.strptime(booked[:10], '%Y-%m-%d').date()
+        details = _children(entry, 'TxDtls')
+        amounts = [_value(detail, ['AmtDtls', 'TxAmt', 'Amt'], ['Amt']) for detail in details]
+        if len(details) > 1 and all(amount is not None for amount in amounts):
+            return [Transaction(date, Decimal(amount), _text(detail)) for detail, amount in zip(details, amounts)]
+        return [Transaction(date, Decimal(_value(entry, ['Amt']) or ''), _text(entry))]
+    except (ValueError, InvalidOperation) as e:
+        raise StatementError('an entry has an invalid date or amount') from e
+
+
+def camt053_transactions(file):
+    """
+    Yields the booked outgoing transactions in a camt.053 statement, leaving out pending and reversed entries. The file
+    is parsed incrementally and every entry is thrown away once it has been read. Batch entries with transaction
+    details give one transaction per detail.
+    """
+    try:
+        for event, element in iterparse(file):
+            if _local(element.tag) == 'Ntry':
+                yield from _camt053_entry(element)
+                element.clear()
+    except ParseError as e:
+        raise StatementError('the statement is not valid XML') from e
+
+
+def _decimal(value):
+    value = value.replace('\xa0', '').replace(' ', '').replace('−', '-')
+    # The last separator is the decimal one and any before it separate thousands, like in "1.234,50" and "1,234.50".
+    # A separator that occurs more than once, like in "1.234.567", only separates thousands.
+    separators = [index for index, char in enumerate(value) if char in ',.']
+    if len(separators) > 1 and len({value[index] for index in separators}) == 1:
+        return Decimal(value.replace(value[separators[0]], ''))
+    if separators:
+        last = separators[-1]
+        value = value[:last].replace(',', '').replace('.', '') + '.' + value[last + 1:]
+    return Decimal(value)
+
+
+def csv_transactions(file, encoding='utf-8'):
+    """
+    Yields the outgoing transactions in a CSV statement. The file needs a header row with the columns Datum, Meddelande
+    and Belopp, separated by commas or semicolons. Outgoing transactions have negative amounts. Rows that can't be
+    read, like a closing balance, are yielded with an error instead of rejecting the statement.
+    """
+    try:
+        yield from _csv_rows(codecs.iterdecode(file, encoding))
+    except (UnicodeDecodeError, csv.Error) as e:
+        raise StatementError('the statement is not ' + encoding + ' CSV') from e
+
+
+def _csv_rows(lines):
+    header = next(lines, '')
+    delimiter = ';' if header.count(';') > header.count(',') else ','
+    fieldnames = next(csv.reader([header], delimiter=delimiter), [])
+    missing = [column for column in CSV_COLUMNS if column not in fieldnames]
+    if missing:
+        raise StatementError('the statement has no column ' + ', '.join(missing))
+
+    for row in csv.DictReader(lines, fieldnames=fieldnames, delimiter=delimiter):
+        text = delimiter.join(value for value in row.values() if isinstance(value, str))
+        if any(row[column] is None for column in CSV_COLUMNS):
+            yield Transaction(None, None, text, 'Raden har inte alla kolumner')
+            continue
+        try:
+            amount = _decimal(row['Belopp'])
+            if amount < 0:
+                yield Transaction(datetime.strptime(row['Datum'].strip(), '%Y-%m-%d').date(), -amount,
+                                  row['Meddelande'])
+        except (ValueError, InvalidOperation):
+            yield Transaction(None, None, text, 'Raden har inget giltigt datum och belopp')
+
+
+def transactions(file, name):
+    """
+    Returns the transactions of a statement file opened in binary mode, read as CSV if its name ends in .csv and as camt.053 otherwise.
+    """
+    if name.lower().endswith('.csv'):
+        return csv_transactions(file)
+    return camt053_transactions(file)
+
+
+def _error(row, message):
+    return {
+        'date': row.date,
+        'amount': row.amount,
+        'text': row.text,
+        'error': message,
+    }
+
+
+def reconcile(rows):
+    """
+    Marks the payments in the transactions in rows as reconciled on their booking dates. Returns the number of matched
+    transactions and a list of the transactions that could not be matched, with the reason.
+    """
+    matched = {}
+    errors = []
+
+    def match(batch):
+        payments = Payment.objects.in_bulk({payment_id for payment_id, _ in batch})
+        for payment_id, row in batch:
+            payment = payments.get(payment_id)
+            if payment is None:
+                errors.append(_error(row, 'Det finns ingen betalning Data' + str(payment_id)))
+            elif payment_id in matched:
+                errors.append(_error(row, 'Betalningen finns redan på en annan rad'))
+            elif payment.total != row.amount:
+                errors.append(_error(row, 'Betalningen är på ' + str(payment.total) + ' kr'))
+            else:
+                matched[payment_id] = row.date
+
+    batch = []
+    for row in rows:
+        if row.error is not None:
+            errors.append(_error(row, row.error))
+            continue
+        tag = TAG_PATTERN.search(row.text)
+        if tag is None:
+            errors.append(_error(row, 'Raden har ingen betalningstagg'))
+            continue
+        batch.append((int(tag.group(1)), row))
+        if len(batch) == BATCH_SIZE:
+            match(batch)
+            batch = []
+    match(batch)
+
+    by_date = {}
+    for payment_id, date in matched.items():
+        by_date.setdefault(date, []).append(payment_id)
+    with transaction.atomic():
+        for date, payment_ids in by_date.items():
+            Payment.objects.filter(id__in=payment_ids).update(reconciled=date)
+
+    return {'matched': len(matched), 'errors': errors}
+
@@ -1,17 +1,38 @@
+import hashlib
+import json
+
 from django import template
 from django.conf import settings
+from django.core.cache import cache
 
 register = template.Library()
+from expenses import queues
 from expenses.models import *
 
 @register.assignment_tag(takes_context=True)
 def counts(context):
-    user = context['request'].user
-    context['counts'] = {
-        'attest': Expense.view_attestable(user.profile.may_view_attest(), user).count() + Invoice.view_attestable(user.profile.may_view_attest(), user).count(),
-        'confirm': Expense.confirmable().count() + 0,
-        'pay': Expense.payable().count() + Invoice.payable().count(),
-        'account': Expense.view_accountable(user.profile.may_view_account()).count() + Invoice.view_accountable(user.profile.may_view_account()).count()
-    }
+    profile = context['request'].user.profile
+    context['counts'] = queue_counts(
+        profile.may_view_attest(),
+        profile.may_view_confirm(),
+        profile.may_view_pay(),
+        profile.may_view_account(),
+    )
 
     return ''
+
+
+def queue_counts(may_attest, may_confirm, may_pay, may_account):
+    """
+    Returns the number of expenses and invoices in each queue for a user with the given permissions.
+    The counts are cached per set of permissions until the queues change or ADMIN_COUNTS_TTL seconds have passed.
+    """
+    scope = json.dumps([sorted(may_attest), bool(may_confirm), bool(may_pay), sorted(may_account)])
+    key = 'admin-counts:' + str(queues.version()) + ':' + hashlib.md5(scope.encode()).hexdigest()
+    counts = cache.get(key)
+    if counts is None:
+        expenses = Expense.queue_counts(may_attest, may_confirm, may_pay, may_account)
+        invoices = Invoice.queue_counts(may_attest, may_pay, may_account)
+        counts = {name: count + invoices.get(name, 0) for name, count in expenses.items()}
+        cache.set(key, counts, settings.ADMIN_COUNTS_TTL)
+    return counts
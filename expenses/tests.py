@@ -1,6 +1,64 @@
 # Create your tests here.
-# This is an economy system. Of course we cannot test an 
+# This is an economy system. Of course we cannot test an
 # economy system, that would be considered smart.
-# 
+#
 # But we keep this file. It both looks good and makes things
 # less complicated when we get serious.
+from datetime import date
+from decimal import Decimal
+from xml.etree import ElementTree
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase, override_settings
+
+from expenses import bankfile
+from expenses.models import BankAccount, Payment, Profile
+
+PAIN = {'pain': bankfile.PAIN_NAMESPACE}
+
+
+@override_settings(BANK_FILE_DEBTOR_NAME='Sektionen', BANK_FILE_DEBTOR_ACCOUNT='12345678901', BANK_FILE_DEBTOR_BIC='')
+class BankFileTest(TestCase):
+    def setUp(self):
+        payer = User.objects.create(username='kassor', first_name='Kassör', last_name='Kassörsson')
+        receiver = User.objects.create(username='medlem', first_name='Anna', last_name='Andersson & Co')
+        Profile.objects.filter(user=receiver).update(bank_name='Banken', sorting_number='8327', bank_account='9876543')
+        account = BankAccount.objects.create(name='Konto')
+        self.payment = Payment.objects.create(
+            payer=payer.profile, receiver=Profile.objects.get(user=receiver), account=account, total=Decimal('123.40')
+        )
+        self.payments = Payment.objects.filter(pk=self.payment.pk)
+
+    def test_pain001(self):
+        xml = ''.join(bankfile.pain001_chunks(self.payments, execution_date=date(2025, 3, 1)))
+        document = ElementTree.fromstring(xml.encode('utf-8'))
+
+        header = document.find('pain:CstmrCdtTrfInitn/pain:GrpHdr', PAIN)
+        self.assertEqual(header.find('pain:NbOfTxs', PAIN).text, '1')
+        self.assertEqual(header.find('pain:CtrlSum', PAIN).text, '123.40')
+
+        info = document.find('pain:CstmrCdtTrfInitn/pain:PmtInf', PAIN)
+        self.assertEqual(info.find('pain:ReqdExctnDt', PAIN).text, '2025-03-01')
+        self.assertEqual(info.find('pain:DbtrAcct/pain:Id/pain:Othr/pain:Id', PAIN).text, '12345678901')
+
+        transfers = info.findall('pain:CdtTrfTxInf', PAIN)
+        self.assertEqual(len(transfers), 1)
+        transfer = transfers[0]
+        self.assertEqual(transfer.find('pain:PmtId/pain:EndToEndId', PAIN).text, self.payment.tag())
+        self.assertEqual(transfer.find('pain:Amt/pain:InstdAmt', PAIN).text, '123.40')
+        self.assertEqual(transfer.find('pain:Cdtr/pain:Nm', PAIN).text, 'Anna Andersson & Co')
+        self.assertEqual(transfer.find('pain:CdtrAcct/pain:Id/pain:Othr/pain:Id', PAIN).text, '83279876543')
+        self.assertEqual(transfer.find('pain:RmtInf/pain:Ustrd', PAIN).text, self.payment.tag())
+
+    def test_csv(self):
+        lines = list(bankfile.csv_lines(self.payments))
+        self.assertEqual(lines, [
+            ','.join(bankfile.CSV_HEADER) + '\r\n',
+            self.payment.tag() + ',Anna Andersson & Co,Banken,8327,9876543,123.40\r\n',
+        ])
+
+    @override_settings(BANK_FILE_DEBTOR_ACCOUNT='')
+    def test_pain001_without_debtor_account(self):
+        with self.assertRaises(ImproperlyConfigured):
+            bankfile.pain001_chunks(self.payments)
@@ -34,6 +34,9 @@ urlpatterns = [
     url(r'^(?P<expense_pk>\d+)/comment/$', views.new_comment, name='expenses-comment'),
 
     url(r'^api/payment/new/$', views.api_new_payment, name='expenses-api-payment-new'),
+    url(r'^api/payment/run/$', views.api_payment_run, name='expenses-api-payment-run'),
+    url(r'^api/payment/reconcile/$', views.api_payment_reconcile, name='expenses-api-payment-reconcile'),
+    url(r'^payment/export/$', views.payment_export, name='expenses-payment-export'),
     url(r'^payment/new/$', views.new_payment, name='expenses-payment-new'),
     url(r'^payment/(?P<pk>\d+)/$', views.get_payment, name='expenses-payment'),
 ]
@@ -1,18 +1,20 @@
 from datetime import datetime
+from itertools import chain
 import re
 import requests
 
 from django.conf import settings
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib import messages
-from django.core.exceptions import ObjectDoesNotExist
+from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
 from django.db import transaction
-from django.http import Http404, HttpResponseRedirect, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse
+from django.http import Http404, HttpResponseRedirect, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse, \
+    StreamingHttpResponse
 from django.shortcuts import render
 from django.urls import reverse
 from django.views.decorators.http import require_http_methods, require_GET, require_POST
 
-from expenses import models
+from expenses import bankfile, models, statements
 
 @require_http_methods(["GET", "POST"])
 @login_required
@@ -339,7 +341,81 @@ def api_new_payment(request):
             content="Betalade ut i betalning " + str(payment.id)
         ).save()
 
+    # The total was updated in the database when the expenses were added
+    payment.refresh_from_db(fields=['total'])
+
     return JsonResponse({
         'payment': payment.to_dict(),
         'expenses': [e.to_dict() for e in expenses]
     })
+
+
+@login_required
+@require_POST
+@user_passes_test(lambda u: u.profile.may_pay())
+def api_payment_run(request):
+    """
+    Pays all payable expenses, or the ones in expense, with one payment per owner. Returns a summary of the run.
+    """
+    try:
+        account = models.BankAccount.objects.get(name=request.POST.get('account'))
+    except ObjectDoesNotExist:
+        return HttpResponseBadRequest("Bankkontot finns inte")
+
+    expense_ids = None
+    if 'expense' in request.POST:
+        try:
+            expense_ids = [int(expense_id) for expense_id in request.POST.getlist('expense')]
+        except ValueError:
+            return HttpResponseBadRequest("Ogiltigt id")
+
+    return JsonResponse(models.Payment.run(request.user.profile, account, expense_ids))
+
+
+@login_required
+@require_POST
+@user_passes_test(lambda u: u.profile.may_pay())
+def api_payment_reconcile(request):
+    """
+    Reconciles payments against the uploaded bank statements in statement, camt.053 or CSV files.
+    """
+    files = request.FILES.getlist('statement')
+    if len(files) == 0:
+        return HttpResponseBadRequest("Inga kontoutdrag valda")
+
+    try:
+        return JsonResponse(statements.reconcile(chain.from_iterable(
+            statements.transactions(file, file.name) for file in files
+        )))
+    except statements.StatementError:
+        return HttpResponseBadRequest("Kontoutdraget kunde inte läsas")
+
+
+@login_required
+@require_GET
+@user_passes_test(lambda u: u.profile.may_pay())
+def payment_export(request):
+    """
+    Streams a bank upload file with the payments in payment, as pain.001 XML or, with format=csv, as CSV.
+    """
+    try:
+        payment_ids = [int(payment_id) for payment_id in request.GET.getlist('payment')]
+    except ValueError:
+        return HttpResponseBadRequest("Ogiltigt id")
+    if len(payment_ids) == 0:
+        return HttpResponseBadRequest("Inga betalningar valda")
+
+    payments = models.Payment.objects.filter(id__in=payment_ids)
+    filename = 'betalningar-' + datetime.now().strftime('%Y-%m-%d')
+    if request.GET.get('format') == 'csv':
+        response = StreamingHttpResponse(bankfile.csv_lines(payments), content_type='text/csv; charset=utf-8')
+        filename += '.csv'
+    else:
+        try:
+            chunks = bankfile.pain001_chunks(payments)
+        except ImproperlyConfigured:
+            return HttpResponseBadRequest("Inget konto att betala från är inställt (BANK_FILE_DEBTOR_ACCOUNT)")
+        response = StreamingHttpResponse(chunks, content_type='application/xml')
+        filename += '.xml'
+    response['Content-Disposition'] = 'attachment; filename="' + filename + '"'
+    return response
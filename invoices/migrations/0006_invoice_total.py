@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.15 on 2026-10-18 03:16
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoices', '0005_auto_20240516_1926'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoice',
+            name='total',
+            field=models.DecimalField(db_index=True, decimal_places=2, default=0, editable=False, max_digits=11),
+        ),
+        migrations.RunSQL(
+            'UPDATE invoices_invoice SET total = COALESCE('
+            '(SELECT SUM(amount) FROM invoices_invoicepart WHERE invoice_id = invoices_invoice.id), 0)',
+            migrations.RunSQL.noop,
+        ),
+    ]
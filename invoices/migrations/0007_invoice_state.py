@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.15 on 2026-10-18 04:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoices', '0006_invoice_total'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoice',
+            name='state',
+            field=models.CharField(choices=[('unattested', 'Inte attesterad'), ('payable', 'Inväntar betalning'), ('paid', 'Betald'), ('accounted', 'Bokförd')], default='unattested', editable=False, max_length=10),
+        ),
+        migrations.RunSQL(
+            "UPDATE invoices_invoice SET state = CASE "
+            "WHEN verification <> '' THEN 'accounted' "
+            "WHEN payed_at IS NOT NULL THEN 'paid' "
+            "WHEN EXISTS (SELECT 1 FROM invoices_invoicepart "
+            "WHERE invoice_id = invoices_invoice.id AND attested_by_id IS NULL) "
+            "OR NOT EXISTS (SELECT 1 FROM invoices_invoicepart WHERE invoice_id = invoices_invoice.id) THEN 'unattested' "
+            "ELSE 'payable' END",
+            migrations.RunSQL.noop,
+        ),
+        # The queues only ever read a small part of the table, so they get partial indexes
+        migrations.RunSQL(
+            "CREATE INDEX invoices_invoice_attest_queue ON invoices_invoice (due_date) WHERE state = 'unattested'",
+            'DROP INDEX invoices_invoice_attest_queue',
+        ),
+        migrations.RunSQL(
+            "CREATE INDEX invoices_invoice_pay_queue ON invoices_invoice (due_date) WHERE state = 'payable'",
+            'DROP INDEX invoices_invoice_pay_queue',
+        ),
+        migrations.RunSQL(
+            "CREATE INDEX invoices_invoice_account_queue ON invoices_invoice (id) WHERE state = 'paid'",
+            'DROP INDEX invoices_invoice_account_queue',
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX invoices_invoicepart_unattested ON invoices_invoicepart (invoice_id) '
+            'WHERE attested_by_id IS NULL',
+            'DROP INDEX invoices_invoicepart_unattested',
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.15 on 2026-10-18 04:41
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def set_cost_centre_keys(apps, schema_editor):
+    InvoicePart = apps.get_model('invoices', 'InvoicePart')
+    cost_centres = InvoicePart.objects.order_by().values_list('cost_centre', flat=True).distinct()
+    for cost_centre in list(cost_centres):
+        # Same normalization as cashflow.dauth.cost_centre_key
+        InvoicePart.objects.filter(cost_centre=cost_centre).update(cost_centre_key=cost_centre.strip().lower())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoices', '0007_invoice_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoicepart',
+            name='cost_centre_key',
+            field=models.TextField(blank=True, db_index=True, editable=False),
+        ),
+        migrations.RunPython(set_cost_centre_keys, migrations.RunPython.noop),
+        # Lets the attest queue of a committee find its unattested parts without reading all of them
+        migrations.RunSQL(
+            'CREATE INDEX invoices_invoicepart_unattested_key ON invoices_invoicepart (cost_centre_key, invoice_id) '
+            'WHERE attested_by_id IS NULL',
+            'DROP INDEX invoices_invoicepart_unattested_key',
+        ),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.15 on 2026-10-18 03:23
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoices', '0008_invoicepart_cost_centre_key'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='invoice',
+            name='due_date',
+            field=models.DateField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='invoice',
+            name='payed_at',
+            field=models.DateField(blank=True, db_index=True, default=None, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='invoicepart',
+            index=models.Index(fields=['invoice', 'attested_by'], name='invoicepart_attest_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='invoicepart',
+            index=models.Index(fields=['cost_centre', 'secondary_cost_centre', 'budget_line'], name='invoicepart_cost_centre_idx'),
+        ),
+        # Unpaid invoices by due date
+        migrations.RunSQL(
+            'CREATE INDEX invoices_invoice_unpaid_due_date ON invoices_invoice (due_date) '
+            'WHERE payed_at IS NULL',
+            'DROP INDEX invoices_invoice_unpaid_due_date',
+        ),
+    ]
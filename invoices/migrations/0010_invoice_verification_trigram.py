@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.15 on 2026-10-18 05:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0029_expense_verification_trigram'),
+        ('invoices', '0009_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='invoice',
+            name='verification',
+            field=models.CharField(blank=True, db_index=True, max_length=7),
+        ),
+        # Used by Invoice.search_verification for substring and similarity matches
+        migrations.RunSQL(
+            'CREATE INDEX invoices_invoice_verification_trgm ON invoices_invoice '
+            'USING gin (verification gin_trgm_ops)',
+            'DROP INDEX invoices_invoice_verification_trgm',
+        ),
+    ]
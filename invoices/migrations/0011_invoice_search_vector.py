@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.15 on 2026-10-18 05:29
+from __future__ import unicode_literals
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoices', '0010_invoice_verification_trigram'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoice',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='invoice',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='invoice_search_vector_idx'),
+        ),
+        # Same vector as Invoice.update_search_vectors
+        migrations.RunSQL(
+            "UPDATE invoices_invoice SET search_vector = "
+            "setweight(to_tsvector('swedish', description), 'A') || "
+            "setweight(to_tsvector('swedish', COALESCE((SELECT string_agg(content, ' ') FROM expenses_comment "
+            "WHERE invoice_id = invoices_invoice.id), '')), 'B')",
+            migrations.RunSQL.noop,
+        ),
+    ]
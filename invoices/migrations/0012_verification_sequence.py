@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.15 on 2026-10-18 03:53
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoices', '0011_invoice_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoice',
+            name='verification_number',
+            field=models.IntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='verification_series',
+            field=models.CharField(blank=True, editable=False, max_length=7),
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='verification_year',
+            field=models.SmallIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(fields=['verification_series', 'verification_year', 'verification_number'], name='invoice_verification_seq_idx'),
+        ),
+        # Same split as split_verification, and same year as verification_year
+        migrations.RunSQL(
+            "UPDATE invoices_invoice SET "
+            "verification_series = upper(substring(trim(verification) from '^([A-Za-z]*)[0-9]+$')), "
+            "verification_number = substring(trim(verification) from '^[A-Za-z]*([0-9]+)$')::integer, "
+            "verification_year = extract(year from payed_at) "
+            "WHERE trim(verification) ~ '^[A-Za-z]*[0-9]+$'",
+            migrations.RunSQL.noop,
+        ),
+    ]
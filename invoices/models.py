@@ -1,5 +1,19 @@
-from django.db import models
+import operator
+from functools import reduce
+
+from django.db import models, transaction
+from django.db.models import Case, DecimalField, F, FloatField, IntegerField, OuterRef, Prefetch, Q, Subquery, Sum, \
+    TextField, Value, When
+from django.db.models.functions import Cast, Coalesce
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.contrib.auth.models import User
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, SearchVectorField, TrigramSimilarity
+
+from cashflow import dauth
+from expenses import queues
 from expenses.models import *
 
 """
@@ -8,15 +22,61 @@ Represents an invoice.
 class Invoice(models.Model):
     created_date = models.DateField(auto_now_add=True)
     invoice_date = models.DateField(blank=True, null=True)
-    due_date = models.DateField(blank=True, null=True)
+    due_date = models.DateField(blank=True, null=True, db_index=True)
     confirmed_by = models.ForeignKey(User, blank=True, null=True)
     confirmed_at = models.DateField(blank=True, null=True, default=None)
     owner = models.ForeignKey('expenses.Profile')
     description = models.TextField()
     file_is_original = models.BooleanField()
-    verification = models.CharField(max_length=7, blank=True)
-    payed_at = models.DateField(blank=True, null=True, default=None)
+    verification = models.CharField(max_length=7, blank=True, db_index=True)
+    # The verification split by expenses.models.split_verification, and its accounting year, the year it was paid. Kept
+    # up to date by save() and bulk_set_verification.
+    verification_series = models.CharField(max_length=7, blank=True, editable=False)
+    verification_year = models.SmallIntegerField(null=True, blank=True, editable=False)
+    verification_number = models.IntegerField(null=True, blank=True, editable=False)
+    payed_at = models.DateField(blank=True, null=True, default=None, db_index=True)
     payed_by = models.ForeignKey(User, blank=True, null=True, default=None, related_name="payed")
+    # Sum of the invoice parts, kept up to date by Invoice.update_totals
+    total = models.DecimalField(max_digits=11, decimal_places=2, default=0, editable=False, db_index=True)
+
+    # Where the invoice is in the workflow, kept up to date by save() and Invoice.update_states.
+    # The queues are read through partial indexes on this field, see migration 0007.
+    UNATTESTED = 'unattested'
+    PAYABLE = 'payable'
+    PAID = 'paid'
+    ACCOUNTED = 'accounted'
+    STATES = (
+        (UNATTESTED, 'Inte attesterad'),
+        (PAYABLE, 'Inväntar betalning'),
+        (PAID, 'Betald'),
+        (ACCOUNTED, 'Bokförd'),
+    )
+    state = models.CharField(max_length=10, choices=STATES, default=UNATTESTED, editable=False)
+    # The queue that an invoice in each state is listed in
+    STATE_QUEUES = {UNATTESTED: 'attest', PAYABLE: 'pay', PAID: 'account'}
+    # The description and comments for full-text search, kept up to date by Invoice.update_search_vectors
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    # Remember which description the invoice had when loaded, see save()
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        invoice = super().from_db(db, field_names, values)
+        invoice._loaded_description = invoice.__dict__.get('description')
+        invoice._loaded_queues = Invoice.queue_names(invoice.__dict__.get('state'))
+        return invoice
+
+    def save(self, *args, **kwargs):
+        from expenses.models import split_verification, verification_year, without_total
+        self.state = self.current_state()
+        self.verification_series, self.verification_number = split_verification(self.verification)
+        self.verification_year = verification_year(self.verification_number, self.payed_at)
+        with transaction.atomic():
+            super().save(*args, **without_total(self, kwargs))
+            if self.description != getattr(self, '_loaded_description', None):
+                Invoice.update_search_vectors([self.pk])
+            queues.bump(*(getattr(self, '_loaded_queues', set()) | Invoice.queue_names(self.state)))
+            self._loaded_description = self.description
+            self._loaded_queues = Invoice.queue_names(self.state)
 
     # Returns a string representation of the invoice
     def __str__(self):
@@ -32,7 +92,46 @@ class Invoice(models.Model):
 
     def status(self):
         if self.verification: return "Bokförd som " + str(self.verification)
-        return "Oklart"
+        return self.get_state_display()
+
+    # Returns the state the invoice should be in, from its fields and parts
+    def current_state(self):
+        if self.verification:
+            return Invoice.ACCOUNTED
+        if self.payed_at:
+            return Invoice.PAID
+        # An invoice without parts has nothing attested yet
+        if self.pk is None or not self.invoicepart_set.exists() or \
+                self.invoicepart_set.filter(attested_by=None).exists():
+            return Invoice.UNATTESTED
+        return Invoice.PAYABLE
+
+    # Returns the names of the queues, see expenses/queues.py, that an invoice with the given state is in
+    @staticmethod
+    def queue_names(state):
+        return {Invoice.STATE_QUEUES[state]} if state in Invoice.STATE_QUEUES else set()
+
+    # Recomputes the stored state of the given invoices, the same way as current_state, and bumps the queues they
+    # were or are in
+    @staticmethod
+    def update_states(invoice_ids):
+        invoices = Invoice.objects.filter(pk__in=invoice_ids)
+        changed = set()
+        for state in invoices.values_list('state', flat=True):
+            changed |= Invoice.queue_names(state)
+
+        parts = InvoicePart.objects.filter(invoice__in=invoice_ids).values('invoice')
+        unattested = InvoicePart.objects.filter(invoice__in=invoice_ids, attested_by=None).values('invoice')
+        invoices.update(state=Case(
+            When(~Q(verification=''), then=Value(Invoice.ACCOUNTED)),
+            When(payed_at__isnull=False, then=Value(Invoice.PAID)),
+            When(Q(pk__in=unattested) | ~Q(pk__in=parts), then=Value(Invoice.UNATTESTED)),
+            default=Value(Invoice.PAYABLE),
+            output_field=models.CharField(),
+        ))
+        for state in invoices.values_list('state', flat=True):
+            changed |= Invoice.queue_names(state)
+        queues.bump(*changed)
 
     def pay(self, user):
         self.payed_by = user
@@ -49,17 +148,59 @@ class Invoice(models.Model):
 
     # Return the total amount of the invoice parts
     def total_amount(self):
-        total = 0
-        for part in self.invoicepart_set.all():
-            total += part.amount
-        return total
+        return self.total
+
+    # Sets the verification numbers in verifications, a list of (invoice, verification), with one update per batch of
+    # invoices. Returns the account comments unsaved, to be saved with Comment.bulk_create_and_notify.
+    @staticmethod
+    def bulk_set_verification(verifications, user, batch_size=500):
+        from expenses.models import Comment, split_verification, verification_year
+        for start in range(0, len(verifications), batch_size):
+            batch = verifications[start:start + batch_size]
+            split = {invoice.pk: split_verification(verification) for invoice, verification in batch}
+            Invoice.objects.filter(pk__in=split.keys()).update(
+                verification=Case(
+                    *[When(pk=invoice.pk, then=Value(verification)) for invoice, verification in batch],
+                    output_field=TextField()
+                ),
+                verification_series=Case(
+                    *[When(pk=pk, then=Value(series)) for pk, (series, _) in split.items()],
+                    output_field=TextField()
+                ),
+                verification_number=Case(
+                    *[When(pk=pk, then=Value(number)) for pk, (_, number) in split.items()],
+                    output_field=IntegerField()
+                ),
+                verification_year=Case(
+                    *[When(pk=invoice.pk, then=Value(verification_year(split[invoice.pk][1], invoice.payed_at)))
+                      for invoice, _ in batch],
+                    output_field=IntegerField()
+                ),
+            )
+        Invoice.update_states([invoice.pk for invoice, _ in verifications])
+        return [Comment(
+            invoice=invoice,
+            author=user.profile,
+            content="Bokförde med verifikationsnumret: " + verification
+        ) for invoice, verification in verifications]
+
+    # Recomputes the stored total of the given invoices
+    @staticmethod
+    def update_totals(invoice_ids):
+        part_totals = InvoicePart.objects.filter(invoice=OuterRef('pk')).order_by() \
+            .values('invoice').annotate(sum=Sum('amount')).values('sum')
+        Invoice.objects.filter(pk__in=invoice_ids).update(
+            total=Coalesce(Subquery(part_totals, output_field=DecimalField()), 0)
+        )
 
     # Returns the cost centres belonging to the invoice as a list [{ cost_centre: 'Name' }, ...]
+    # Reads the parts through the prefetch cache when they were loaded with with_related
     def cost_centres(self):
-        return self.invoicepart_set.order_by('cost_centre').values('cost_centre').distinct()
+        return [{'cost_centre': cost_centre}
+                for cost_centre in sorted({part.cost_centre for part in self.invoicepart_set.all()})]
 
     def is_attested(self):
-        return self.invoicepart_set.filter(attested_by__isnull=True).count() == 0
+        return not self.invoicepart_set.filter(attested_by__isnull=True).exists()
 
     def is_payed(self):
         if self.payed_at and self.payed_by:
@@ -77,40 +218,152 @@ class Invoice(models.Model):
     # Returns a dict representation of the model
     def to_dict(self):
         exp = model_to_dict(self)
-        exp['invoice_parts'] = [part.to_dict() for part in InvoicePart.objects.filter(invoice=self)]
+        parts = self.invoicepart_set.all()
+        exp['invoice_parts'] = [part.to_dict() for part in parts]
         exp['owner_username'] = self.owner.user.username
         exp['owner_first_name'] = self.owner.user.first_name
         exp['owner_last_name'] = self.owner.user.last_name
-        exp['amount'] = self.total_amount()
+        exp['amount'] = self.total
         exp['cost_centres'] = [cost_centre['cost_centre'] for cost_centre in self.cost_centres()]
         return exp
 
+    # Returns the invoices with everything that to_dict uses fetched in a constant number of queries
+    @staticmethod
+    def with_related(invoices):
+        return invoices.select_related('owner__user').prefetch_related(Prefetch(
+            'invoicepart_set',
+            queryset=InvoicePart.objects.select_related('attested_by__user').order_by('id')
+        ))
+
+    # Returns a list of dict representations of the invoices
+    @staticmethod
+    def bulk_to_dict(invoices):
+        return [invoice.to_dict() for invoice in Invoice.with_related(invoices)]
+
+    # Returns the invoices as lightweight rows for the queue endpoints, see add_parts
+    @staticmethod
+    def queue_rows(invoices):
+        return invoices.values(
+            'id', 'description', 'invoice_date', 'due_date', 'created_date', 'verification',
+            amount=F('total'),
+            owner_username=F('owner__user__username'),
+            owner_first_name=F('owner__user__first_name'),
+            owner_last_name=F('owner__user__last_name'),
+        )
+
+    # Adds the parts and cost centres to rows from queue_rows, in one query
+    @staticmethod
+    def add_parts(rows):
+        parts = {}
+        for part in InvoicePart.objects.filter(invoice_id__in=[row['id'] for row in rows]).order_by('id').values(
+                'id', 'invoice_id', 'cost_centre', 'secondary_cost_centre', 'budget_line', 'amount', 'attested_by'):
+            parts.setdefault(part.pop('invoice_id'), []).append(part)
+        for row in rows:
+            row['parts'] = parts.get(row['id'], [])
+            row['cost_centres'] = sorted({part['cost_centre'] for part in row['parts']})
+        return rows
+
+    # Recomputes the full-text search vector of the given invoices from their description and comments
+    @staticmethod
+    def update_search_vectors(invoice_ids):
+        from expenses.models import Comment
+        comments = Comment.objects.filter(invoice=OuterRef('pk')).order_by().values('invoice') \
+            .annotate(text=StringAgg('content', ' ')).values('text')
+        Invoice.objects.filter(pk__in=invoice_ids).update(
+            search_vector=SearchVector('description', config='swedish', weight='A') +
+            SearchVector(Subquery(comments, output_field=TextField()), config='swedish', weight='B')
+        )
+
+    # Returns the invoices matching the full-text query, best match first. score is the rank as an integer,
+    # so that it can be used in a pagination cursor.
+    @staticmethod
+    def search(query):
+        query = SearchQuery(query, config='swedish')
+        return Invoice.objects.filter(search_vector=query).annotate(
+            score=Cast(SearchRank(F('search_vector'), query) * Value(1000000, output_field=FloatField()), IntegerField())
+        ).order_by('-score', '-id')
+
+    # Returns the invoices paid in year that are accounted in series, by sequence number
+    @staticmethod
+    def verification_sequence(series, year):
+        return Invoice.objects \
+            .filter(verification_series=series, verification_year=year, verification_number__isnull=False) \
+            .order_by('verification_number', 'id')
+
+    # Returns the invoices whose verification matches query, prefix matches first and then by similarity
+    @staticmethod
+    def search_verification(query):
+        matches = Q(verification__contains=query)
+        if len(query) >= 3:
+            # Shorter queries have no trigrams to compare, so they only match as substrings
+            matches |= Q(verification__trigram_similar=query)
+        return Invoice.objects.filter(matches).annotate(
+            prefix=Case(
+                When(verification__startswith=query, then=Value(1)),
+                default=Value(0),
+                output_field=models.IntegerField()
+            ),
+            similarity=TrigramSimilarity('verification', query),
+        ).order_by('-prefix', '-similarity', 'verification')
+
     @staticmethod
     def view_attestable(may_attest, user):
-        filters = {
-            'invoicepart__attested_by': None,
-        }
-        if 'firmatecknare' not in may_attest:
-            filters['invoicepart__cost_centre__iregex'] = r'(' + '|'.join(may_attest) + ')'
-        return Invoice.objects.order_by('-due_date').filter(**filters).distinct()
+        invoices = Invoice.objects.filter(state=Invoice.UNATTESTED)
+        if 'firmatecknare' not in may_attest and '*' not in may_attest:
+            invoices = invoices.filter(pk__in=InvoicePart.objects.filter(
+                attested_by=None,
+                cost_centre_key__in=may_attest
+            ).values('invoice'))
+        return invoices.order_by('-due_date')
 
-    # TODO
     @staticmethod
     def payable():
-        return Invoice.objects. \
-            exclude(payed_at__isnull=False). \
-            exclude(invoicepart__attested_by=None). \
-            order_by('due_date')
+        return Invoice.objects.filter(state=Invoice.PAYABLE).order_by('due_date')
 
-    # TODO
     @staticmethod
     def view_accountable(may_account):
-        if '*' in may_account:
-            return Invoice.objects.exclude(payed_at__isnull=True).filter(verification='').distinct()
-        return Invoice.objects.exclude(payed_at__isnull=True).filter(
-            verification='',
-            invoicepart__cost_centre__iregex=r'(' + '|'.join(may_account) + ')'
-        ).distinct()
+        invoices = Invoice.objects.filter(state=Invoice.PAID)
+        if '*' not in may_account:
+            invoices = invoices.filter(pk__in=InvoicePart.objects.filter(
+                cost_centre_key__in=may_account
+            ).values('invoice'))
+        return invoices
+
+    # Returns the number of invoices in each queue that a user with the given permissions may view, in one query.
+    # The permissions are those returned by Profile.may_view_attest and friends, a queue with no permission counts 0.
+    @staticmethod
+    def queue_counts(may_attest, may_pay, may_account):
+        conditions = {}
+        if may_attest:
+            conditions['attest'] = Q(state=Invoice.UNATTESTED)
+            if 'firmatecknare' not in may_attest and '*' not in may_attest:
+                conditions['attest'] &= Q(pk__in=InvoicePart.objects.filter(
+                    attested_by=None,
+                    cost_centre_key__in=may_attest
+                ).values('invoice'))
+        if may_pay:
+            conditions['pay'] = Q(state=Invoice.PAYABLE)
+        if may_account:
+            conditions['account'] = Q(state=Invoice.PAID)
+            if '*' not in may_account:
+                conditions['account'] &= Q(pk__in=InvoicePart.objects.filter(
+                    cost_centre_key__in=may_account
+                ).values('invoice'))
+
+        counts = {'attest': 0, 'pay': 0, 'account': 0}
+        if conditions:
+            counts.update(Invoice.objects.filter(reduce(operator.or_, conditions.values())).aggregate(**{
+                name: Sum(Case(When(condition, then=Value(1)), default=Value(0), output_field=IntegerField()))
+                for name, condition in conditions.items()
+            }))
+        return {name: count or 0 for name, count in counts.items()}
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector'], name='invoice_search_vector_idx'),
+            models.Index(fields=['verification_series', 'verification_year', 'verification_number'],
+                         name='invoice_verification_seq_idx'),
+        ]
 
 """
 Defines an invoice part, which is a specification of a part of an invoice.
@@ -118,6 +371,8 @@ Defines an invoice part, which is a specification of a part of an invoice.
 class InvoicePart(models.Model):
     invoice = models.ForeignKey(Invoice, on_delete=models.CASCADE)
     cost_centre = models.TextField(blank=True)
+    # The cost centre normalized with dauth.cost_centre_key, used to match it against permissions
+    cost_centre_key = models.TextField(blank=True, editable=False, db_index=True)
     secondary_cost_centre = models.TextField(blank=True)
     budget_line = models.TextField(blank=True)
     amount = models.DecimalField(max_digits=9, decimal_places=2)
@@ -132,6 +387,13 @@ class InvoicePart(models.Model):
     def __unicode__(self):
         return self.invoice.__unicode__() + " (" + self.budget_line + ": " + str(self.amount) + " kr)"
 
+    def save(self, *args, **kwargs):
+        self.cost_centre_key = dauth.cost_centre_key(self.cost_centre)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            Invoice.update_totals([self.invoice_id])
+            Invoice.update_states([self.invoice_id])
+
     def attest(self, user):
         self.attested_by = user.profile
         self.attest_date = date.today()
@@ -145,6 +407,22 @@ class InvoicePart(models.Model):
         )
         comment.save()
 
+    # Attests the parts like attest, with one update for all parts. The parts must have their invoice loaded and not be
+    # attested. Returns the attest comments unsaved, to be saved with Comment.bulk_create_and_notify.
+    @staticmethod
+    def bulk_attest(parts, user):
+        from expenses.models import Comment
+        InvoicePart.objects.filter(pk__in=[part.pk for part in parts]).update(
+            attested_by=user.profile,
+            attest_date=date.today()
+        )
+        Invoice.update_states({part.invoice_id for part in parts})
+        return [Comment(
+            author=user.profile,
+            invoice=part.invoice,
+            content="Attesterar fakturadelen ```" + str(part) + "```"
+        ) for part in parts]
+
     # Returns dict representation of the model
     def to_dict(self):
         exp_part = model_to_dict(self)
@@ -154,3 +432,25 @@ class InvoicePart(models.Model):
             exp_part['attested_by_first_name'] = self.attested_by.user.first_name
             exp_part['attested_by_last_name'] = self.attested_by.user.last_name
         return exp_part
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['invoice', 'attested_by'], name='invoicepart_attest_idx'),
+            models.Index(fields=['cost_centre', 'secondary_cost_centre', 'budget_line'],
+                         name='invoicepart_cost_centre_idx'),
+        ]
+
+
+# Deleting parts, also through querysets and cascades, changes the total and state. Runs in the deleting transaction.
+# noinspection PyUnusedLocal
+@receiver(post_delete, sender=InvoicePart)
+def update_invoice_total(sender, instance, **kwargs):
+    Invoice.update_totals([instance.invoice_id])
+    Invoice.update_states([instance.invoice_id])
+
+
+# Anything cached from the queues that the invoice was in is outdated when it is deleted, save() handles changes
+# noinspection PyUnusedLocal
+@receiver(post_delete, sender=Invoice)
+def bump_invoice_queues(sender, instance, **kwargs):
+    queues.bump(*Invoice.queue_names(instance.state))
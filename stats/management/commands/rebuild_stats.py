@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from django.core.cache import cache
+
+from stats.models import ExpenseRollup, monthly_key
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the statistics rollup from all expenses and removes the cached statistics.'
+
+    def handle(self, *args, **options):
+        ExpenseRollup.rebuild()
+        years = ExpenseRollup.objects.order_by().values_list('year', flat=True).distinct()
+        cache.delete_many([monthly_key(year) for year in years])
+        self.stdout.write('Rebuilt the statistics rollup with ' + str(ExpenseRollup.objects.count()) + ' rows')
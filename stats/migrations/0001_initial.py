@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.15 on 2026-10-18 03:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('expenses', '0032_verification_sequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExpenseRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.SmallIntegerField()),
+                ('month', models.SmallIntegerField()),
+                ('cost_centre', models.TextField()),
+                ('secondary_cost_centre', models.TextField()),
+                ('budget_line', models.TextField()),
+                ('reimbursed', models.BooleanField()),
+                ('expenses', models.IntegerField(default=0)),
+                ('parts', models.IntegerField(default=0)),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=11)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='expenserollup',
+            unique_together=set([('year', 'month', 'cost_centre', 'secondary_cost_centre', 'budget_line', 'reimbursed')]),
+        ),
+        # Same rows as ExpenseRollup.rebuild
+        migrations.RunSQL(
+            "INSERT INTO stats_expenserollup (year, month, cost_centre, secondary_cost_centre, budget_line, reimbursed, "
+            "expenses, parts, amount) "
+            "SELECT year, month, cost_centre, secondary_cost_centre, budget_line, reimbursed, "
+            "sum(expenses), sum(parts), sum(amount) FROM ("
+            "SELECT extract(year FROM e.expense_date) AS year, extract(month FROM e.expense_date) AS month, "
+            "p.cost_centre, p.secondary_cost_centre, p.budget_line, e.reimbursement_id IS NOT NULL AS reimbursed, "
+            "0 AS expenses, count(*) AS parts, sum(p.amount) AS amount "
+            "FROM expenses_expensepart p JOIN expenses_expense e ON e.id = p.expense_id GROUP BY 1, 2, 3, 4, 5, 6 "
+            "UNION ALL "
+            "SELECT extract(year FROM e.expense_date), extract(month FROM e.expense_date), '', '', '', "
+            "e.reimbursement_id IS NOT NULL, count(*), 0, 0 FROM expenses_expense e GROUP BY 1, 2, 3, 4, 5, 6"
+            ") groups GROUP BY 1, 2, 3, 4, 5, 6",
+            migrations.RunSQL.noop,
+        ),
+    ]
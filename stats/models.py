@@ -0,0 +1,242 @@
+"""
+The statistics rollup and the invalidation of the cached statistics.
+
+ExpenseRollup holds the number of expenses and parts and the sum of the parts
+per month and budget line, so that the statistics are read from a few rows
+instead of from every part. It is kept up to date in the transaction that
+changes the expenses, by the signals below, which add the difference that the
+change makes to the affected rows. It can be rebuilt with
+`./manage.py rebuild_stats`.
+
+The monthly chart is also cached per year of expense date, see stats/views.py.
+The cache of a year is removed when an expense or expense part in it is saved
+or deleted, after the transaction commits so that nothing older is cached again.
+"""
+
+from itertools import chain
+
+from django.core.cache import cache
+from django.db import connection, models, transaction
+from django.db.models import BooleanField, Case, Count, Sum, TextField, Value, When
+from django.db.models.functions import ExtractMonth, ExtractYear
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from expenses.models import Expense, ExpensePart, expenses_reimbursed
+
+# The budget fields of the rows that count the expenses
+NO_BUDGET = ('', '', '')
+
+
+class ExpenseRollup(models.Model):
+    """
+    The expenses of a month with a budget line, split by whether they are reimbursed. Every part is counted in parts
+    and amount in the row of its budget line. Every expense is counted in expenses once, in the row of its month
+    with empty budget fields.
+    """
+    year = models.SmallIntegerField()
+    month = models.SmallIntegerField()
+    cost_centre = models.TextField()
+    secondary_cost_centre = models.TextField()
+    budget_line = models.TextField()
+    reimbursed = models.BooleanField()
+    expenses = models.IntegerField(default=0)
+    parts = models.IntegerField(default=0)
+    amount = models.DecimalField(max_digits=11, decimal_places=2, default=0)
+
+    GROUP = ('year', 'month', 'cost_centre', 'secondary_cost_centre', 'budget_line', 'reimbursed')
+
+    # Returns the parts grouped like the rollup, with their number and sum
+    @staticmethod
+    def part_groups(parts):
+        return parts.annotate(
+            year=ExtractYear('expense__expense_date'),
+            month=ExtractMonth('expense__expense_date'),
+            reimbursed=Case(
+                When(expense__reimbursement__isnull=False, then=Value(True)),
+                default=Value(False),
+                output_field=BooleanField(),
+            ),
+        ).order_by().values(*ExpenseRollup.GROUP).annotate(parts=Count('id'), amount=Sum('amount'))
+
+    # Returns the expenses grouped like the rollup, with their number
+    @staticmethod
+    def expense_groups(expenses):
+        return expenses.annotate(
+            year=ExtractYear('expense_date'),
+            month=ExtractMonth('expense_date'),
+            cost_centre=Value('', output_field=TextField()),
+            secondary_cost_centre=Value('', output_field=TextField()),
+            budget_line=Value('', output_field=TextField()),
+            reimbursed=Case(
+                When(reimbursement__isnull=False, then=Value(True)),
+                default=Value(False),
+                output_field=BooleanField(),
+            ),
+        ).order_by().values(*ExpenseRollup.GROUP).annotate(expenses=Count('id'))
+
+    # Returns the unsaved rollup rows of the expenses, which must be the expenses of the parts
+    @staticmethod
+    def compute(expenses, parts):
+        rows = {}
+        for group in ExpenseRollup.expense_groups(expenses):
+            key = tuple(group[field] for field in ExpenseRollup.GROUP)
+            rows[key] = ExpenseRollup(expenses=group['expenses'], **dict(zip(ExpenseRollup.GROUP, key)))
+        for group in ExpenseRollup.part_groups(parts):
+            key = tuple(group[field] for field in ExpenseRollup.GROUP)
+            row = rows.setdefault(key, ExpenseRollup(**dict(zip(ExpenseRollup.GROUP, key))))
+            row.parts = group['parts']
+            row.amount = group['amount']
+        return list(rows.values())
+
+    # Adds the changes, given as (group, expenses, parts, amount) with the group ordered like GROUP, to the rows of
+    # the rollup with one statement, and removes the rows that become empty. Returns the years that changed.
+    @staticmethod
+    def add(changes):
+        totals = {}
+        for key, expenses, parts, amount in changes:
+            total = totals.setdefault(tuple(key), [0, 0, 0])
+            total[0] += expenses
+            total[1] += parts
+            total[2] += amount
+        # Rows are locked in a fixed order, so that concurrent transactions don't deadlock on them
+        rows = sorted((key, total) for key, total in totals.items() if any(total))
+        if not rows:
+            return set()
+
+        table = ExpenseRollup._meta.db_table
+        columns = ', '.join(ExpenseRollup.GROUP)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO ' + table + ' (' + columns + ', expenses, parts, amount) VALUES ' +
+                ', '.join(['(%s, %s, %s, %s, %s, %s, %s, %s, %s)'] * len(rows)) +
+                ' ON CONFLICT (' + columns + ') DO UPDATE SET expenses = ' + table + '.expenses + excluded.expenses, '
+                'parts = ' + table + '.parts + excluded.parts, amount = ' + table + '.amount + excluded.amount '
+                'RETURNING id, expenses, parts',
+                [value for key, total in rows for value in key + tuple(total)]
+            )
+            empty = [pk for pk, expenses, parts in cursor.fetchall() if expenses == 0 and parts == 0]
+            if empty:
+                cursor.execute('DELETE FROM ' + table + ' WHERE id = ANY(%s)', [empty])
+        return {key[0] for key, _ in rows}
+
+    # Recomputes the whole rollup
+    @staticmethod
+    def rebuild():
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute('LOCK TABLE ' + ExpenseRollup._meta.db_table + ' IN EXCLUSIVE MODE')
+            ExpenseRollup.objects.all().delete()
+            ExpenseRollup.objects.bulk_create(
+                ExpenseRollup.compute(Expense.objects.all(), ExpensePart.objects.all()),
+                batch_size=1000,
+            )
+
+    class Meta:
+        unique_together = ('year', 'month', 'cost_centre', 'secondary_cost_centre', 'budget_line', 'reimbursed')
+
+
+# Returns the cache key of the monthly chart data of year
+def monthly_key(year):
+    return 'stats-monthly:' + str(year)
+
+
+# Returns the year and month of an expense date, which is a string until the expense has been loaded from the database
+def expense_month(expense_date):
+    if not expense_date:
+        return None
+    return int(str(expense_date)[:4]), int(str(expense_date)[5:7])
+
+
+# Returns the rollup group of an expense in the month, or of its parts with the budget fields
+def rollup_group(month, reimbursed, budget=NO_BUDGET):
+    return month + tuple(budget) + (reimbursed,)
+
+
+# Removes the cached statistics of the years when the transaction commits
+def forget_years(*years):
+    keys = [monthly_key(year) for year in set(years) if year is not None]
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+# Returns the month and whether it is reimbursed that the expense had when it was loaded, or that it has if it wasn't
+def loaded_group(expense):
+    if not hasattr(expense, '_loaded_expense_date'):
+        return expense_month(expense.expense_date), expense.reimbursement_id is not None
+    return expense_month(expense._loaded_expense_date), expense._loaded_reimbursement_id is not None
+
+
+# Returns the month and whether it is reimbursed of each of the expenses, as stored
+def stored_groups(expense_ids):
+    return {pk: (expense_month(expense_date), reimbursement_id is not None) for pk, expense_date, reimbursement_id
+            in Expense.objects.filter(pk__in=expense_ids).values_list('pk', 'expense_date', 'reimbursement_id')}
+
+
+# A new expense has no parts yet. An expense that changes month or payment moves along with its parts.
+# noinspection PyUnusedLocal
+@receiver(post_save, sender=Expense)
+def update_expense_rollup(sender, instance, created, **kwargs):
+    new = (expense_month(instance.expense_date), instance.reimbursement_id is not None)
+    if created:
+        forget_years(*ExpenseRollup.add([(rollup_group(*new), 1, 0, 0)]))
+        return
+
+    old = loaded_group(instance)
+    if old == new:
+        return
+    changes = [(rollup_group(*old), -1, 0, 0), (rollup_group(*new), 1, 0, 0)]
+    parts = ExpensePart.objects.filter(expense=instance).order_by() \
+        .values_list('cost_centre', 'secondary_cost_centre', 'budget_line') \
+        .annotate(count=Count('id'), sum=Sum('amount'))
+    for cost_centre, secondary_cost_centre, budget_line, count, amount in parts:
+        budget = (cost_centre, secondary_cost_centre, budget_line)
+        changes += [
+            (rollup_group(*old, budget=budget), 0, -count, -amount),
+            (rollup_group(*new, budget=budget), 0, count, amount),
+        ]
+    forget_years(*ExpenseRollup.add(changes))
+
+
+# The parts of an expense are deleted, and removed from the rollup, before the expense itself
+# noinspection PyUnusedLocal
+@receiver(post_delete, sender=Expense)
+def remove_expense_rollup(sender, instance, **kwargs):
+    forget_years(*ExpenseRollup.add([(rollup_group(*loaded_group(instance)), -1, 0, 0)]))
+
+
+# noinspection PyUnusedLocal
+@receiver(post_save, sender=ExpensePart)
+def update_part_rollup(sender, instance, created, **kwargs):
+    old_expense_id = getattr(instance, '_loaded_expense_id', None)
+    expenses = stored_groups({instance.expense_id, old_expense_id} - {None})
+    budget = (instance.cost_centre, instance.secondary_cost_centre, instance.budget_line)
+    changes = [(rollup_group(*expenses[instance.expense_id], budget=budget), 0, 1, instance.amount)]
+    if old_expense_id is not None:
+        old = rollup_group(*expenses[old_expense_id], budget=instance._loaded_budget)
+        changes.append((old, 0, -1, -instance._loaded_amount))
+    forget_years(*ExpenseRollup.add(changes))
+
+
+# noinspection PyUnusedLocal
+@receiver(post_delete, sender=ExpensePart)
+def remove_part_rollup(sender, instance, **kwargs):
+    expense_id = getattr(instance, '_loaded_expense_id', instance.expense_id)
+    budget = getattr(instance, '_loaded_budget',
+                     (instance.cost_centre, instance.secondary_cost_centre, instance.budget_line))
+    amount = getattr(instance, '_loaded_amount', instance.amount)
+    old = rollup_group(*stored_groups([expense_id])[expense_id], budget=budget)
+    forget_years(*ExpenseRollup.add([(old, 0, -1, -amount)]))
+
+
+# The expenses of a payment run go from not reimbursed to reimbursed, with their parts
+# noinspection PyUnusedLocal
+@receiver(expenses_reimbursed)
+def update_reimbursed_rollup(sender, expense_ids, **kwargs):
+    changes = []
+    for row in chain(ExpenseRollup.expense_groups(Expense.objects.filter(pk__in=expense_ids)),
+                     ExpenseRollup.part_groups(ExpensePart.objects.filter(expense_id__in=expense_ids))):
+        key = tuple(row[field] for field in ExpenseRollup.GROUP[:-1])
+        expenses, parts, amount = row.get('expenses', 0), row.get('parts', 0), row.get('amount', 0)
+        changes += [(key + (False,), -expenses, -parts, -amount), (key + (True,), expenses, parts, amount)]
+    forget_years(*ExpenseRollup.add(changes))
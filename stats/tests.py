@@ -0,0 +1,65 @@
+from datetime import date
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from expenses.models import Expense, ExpensePart
+from stats.models import NO_BUDGET, ExpenseRollup
+
+
+class ExpenseRollupTest(TestCase):
+    def setUp(self):
+        owner = User.objects.create(username='medlem')
+        self.expense = Expense.objects.create(owner=owner.profile, expense_date=date(2025, 3, 1), description='Mat')
+
+    # Returns the rollup rows as {(cost_centre, budget_line): (expenses, parts, amount)}
+    def rows(self):
+        return {(row.cost_centre, row.budget_line): (row.expenses, row.parts, row.amount)
+                for row in ExpenseRollup.objects.all()}
+
+    # Asserts that the rollup is what a rebuild computes
+    def assertRebuilt(self):
+        rows = self.rows()
+        ExpenseRollup.rebuild()
+        self.assertEqual(rows, self.rows())
+
+    def test_part_with_string_amount(self):
+        # Like the new expense form, which gives the amounts as strings
+        ExpensePart(expense=self.expense, cost_centre='Mottagningen', budget_line='Mat', amount='123.50').save()
+        self.assertEqual(self.rows(), {
+            (NO_BUDGET[0], NO_BUDGET[2]): (1, 0, Decimal(0)),
+            ('Mottagningen', 'Mat'): (0, 1, Decimal('123.50')),
+        })
+        self.assertRebuilt()
+
+    def test_edit_part_with_string_and_float_amount(self):
+        part = ExpensePart(expense=self.expense, cost_centre='Mottagningen', budget_line='Mat', amount='100')
+        part.save()
+
+        # Like the edit expense form
+        part.amount = '40.25'
+        part.budget_line = 'Dryck'
+        part.save()
+        self.assertEqual(self.rows(), {
+            (NO_BUDGET[0], NO_BUDGET[2]): (1, 0, Decimal(0)),
+            ('Mottagningen', 'Dryck'): (0, 1, Decimal('40.25')),
+        })
+
+        # Like the API, which gives the amount as a float, on a part loaded from the database
+        part = ExpensePart.objects.get(pk=part.pk)
+        part.amount = 12.5
+        part.save()
+        self.assertEqual(self.rows()[('Mottagningen', 'Dryck')], (0, 1, Decimal('12.50')))
+        self.assertRebuilt()
+
+        part.delete()
+        self.assertEqual(self.rows(), {(NO_BUDGET[0], NO_BUDGET[2]): (1, 0, Decimal(0))})
+
+    def test_delete_expense(self):
+        ExpensePart(expense=self.expense, cost_centre='Mottagningen', budget_line='Mat', amount='10').save()
+        ExpensePart(expense=self.expense, cost_centre='Mottagningen', budget_line='Mat', amount='5').save()
+        self.assertEqual(self.rows()[('Mottagningen', 'Mat')], (0, 2, Decimal('15')))
+
+        self.expense.delete()
+        self.assertEqual(self.rows(), {})
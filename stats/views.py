@@ -1,22 +1,24 @@
 from datetime import datetime
 
 from django.db.models import Sum, Count
-from django.db.models.functions import TruncMonth, Coalesce
+from django.db.models.functions import Coalesce
 from django.shortcuts import render
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_GET
 from django.http import JsonResponse, HttpResponseBadRequest
 from django.conf import settings
+from django.core.cache import cache
 
 import json
 
 from expenses import models
+from stats.models import ExpenseRollup, monthly_key
 
 
 def index(request):
-    year = models.Expense.objects \
-        .filter(expense_date__year=datetime.now().year, reimbursement__isnull=False) \
-        .aggregate(sum=Coalesce(Sum('expensepart__amount'), 0))['sum']
+    year = ExpenseRollup.objects \
+        .filter(year=datetime.now().year, reimbursed=True) \
+        .aggregate(sum=Coalesce(Sum('amount'), 0))['sum']
 
     highscore = models.Profile.objects \
         .filter(expense__reimbursement__isnull=False, expense__expensepart__amount__lt=10000) \
@@ -42,10 +44,14 @@ def index(request):
         'budget_url': settings.BUDGET_URL,
     })
 
+
+# Returns the rollup rows of year with parts, narrowed by the given budget fields
+def rollup(year, **fields):
+    return ExpenseRollup.objects.filter(year=year, parts__gt=0, **fields).order_by()
+
+
 @require_GET
 def summary(request):
-    expense_parts = None
-
     cost_centre = request.GET.get('cost_centre')
     year = request.GET.get('year')
     secondary_cost_centre = request.GET.get('secondary_cost_centre')
@@ -53,127 +59,56 @@ def summary(request):
 
     if not cost_centre or not year:
         return JsonResponse({'error': 'cost_centre and year are required'}, status=400)
-    if secondary_cost_centre == '':
-        # Filter ExpensePart by cost_centre and year
-        expense_parts = models.ExpensePart.objects.filter(
-            cost_centre=cost_centre,
-            expense__expense_date__year=year
-        ).all()
-    elif budget_line == '':
-        # Filter ExpensePart by cost_centre and year
-        expense_parts = models.ExpensePart.objects.filter(
-            cost_centre=cost_centre,
-            expense__expense_date__year=year,
-            secondary_cost_centre=secondary_cost_centre
-        ).all()
-    else:
-        # Filter ExpensePart by cost_centre and year
-        expense_parts = models.ExpensePart.objects.filter(
-            cost_centre=cost_centre,
-            expense__expense_date__year=year,
-            secondary_cost_centre=secondary_cost_centre,
-            budget_line = budget_line
-        ).all()
-
-    sum_amount = 0
-    expense_parts_list = []  # To store each expense part for debugging or detailed view
-
-    for expense_part in expense_parts:
-        sum_amount += expense_part.amount
-        # Optionally add the expense part details to the response
-        expense_parts_list.append({
-            'expense': str(expense_part.expense),  # String representation of the expense
-            'amount': float(expense_part.amount),  # Convert to float for JSON compatibility
-            'budget_line': expense_part.budget_line
-        })
+
+    fields = {'cost_centre': cost_centre}
+    if secondary_cost_centre:
+        fields['secondary_cost_centre'] = secondary_cost_centre
+        if budget_line:
+            fields['budget_line'] = budget_line
 
     return JsonResponse({
-        'amount': sum_amount,
+        'amount': rollup(year, **fields).aggregate(sum=Sum('amount'))['sum'] or 0,
     })
 
 
 @require_GET
 def sec_cost_centres(request):
-    expense_parts = None
-
     cost_centre = request.GET.get('cost_centre')
     year = request.GET.get('year')
     if not cost_centre or not year:
         return JsonResponse({'error': 'cost_centre and year are required'}, status=400)
 
-    # Filter ExpensePart by cost_centre and year
-    expense_parts = models.ExpensePart.objects.filter(
-        cost_centre=cost_centre,
-        expense__expense_date__year=year
-    ).all()
-    
-    sec_cost_centres = set()
-
-    for expense_part in expense_parts:
-        sec_cost_centres.add(expense_part.secondary_cost_centre)
-        # Optionally add the expense part details to the response
-
-    sec_cost_centres_list = list(sec_cost_centres)
-
     return JsonResponse({
-        'sec_cost_centres': sec_cost_centres_list
+        'sec_cost_centres': list(rollup(year, cost_centre=cost_centre)
+                                 .values_list('secondary_cost_centre', flat=True).distinct())
     })
 
+
 @require_GET
 def budget_lines(request):
-    expense_parts = None
-
     cost_centre = request.GET.get('cost_centre')
     year = request.GET.get('year')
     secondary_cost_centre = request.GET.get('secondary_cost_centre')
     if not cost_centre or not year or not secondary_cost_centre:
         return JsonResponse({'error': 'cost_centre and year are required'}, status=400)
 
-    # Filter ExpensePart by cost_centre and year
-    expense_parts = models.ExpensePart.objects.filter(
-        cost_centre=cost_centre,
-        expense__expense_date__year=year,
-        secondary_cost_centre = secondary_cost_centre
-    ).all()
-    
-    budget_lines = set()
-
-    for expense_part in expense_parts:
-        budget_lines.add(expense_part.budget_line)
-
-    budget_lines_list = list(budget_lines)
-
     return JsonResponse({
-        'budget_lines': budget_lines_list
+        'budget_lines': list(rollup(year, cost_centre=cost_centre, secondary_cost_centre=secondary_cost_centre)
+                             .values_list('budget_line', flat=True).distinct())
     })
 
 
-
 @require_GET
 def cost_centres(request):
     """
     Returns the distinct cost centres (committees) from all expenses.
     """
-    expense_queryset = models.Expense.objects.all()
-    # expense_queryset is a list of expenses 
-
-    
-    # Collecting cost centres from each expense
-    cost_centres = set()  # Use a set to avoid duplicates
-
-    for expense in expense_queryset:
-        for cost_centre in expense.cost_centres():
-            cost_centres.add(cost_centre['cost_centre'])
-
-    # Convert the set back to a list
-    cost_centres_list = list(cost_centres)
-
     return JsonResponse({
-        'cost_centres': cost_centres_list
+        'cost_centres': list(ExpenseRollup.objects.filter(parts__gt=0).order_by()
+                             .values_list('cost_centre', flat=True).distinct())
     })
 
 
-
 @require_GET
 def monthly(_request, year):
     try:
@@ -190,20 +125,22 @@ def monthly(_request, year):
 
 
 def monthly_chart_data(year):
+    """
+    Returns the number of expenses and their total amount per month of year, as two lists of 12 values. Read from the
+    rollup and cached, past years until they change, see stats/models.py.
+    """
     if not isinstance(year, int) or year < 2000 or year > 3000:
         raise ValueError
 
-    months = models.Expense.objects.filter(expense_date__year=year) \
-        .annotate(date=TruncMonth('expense_date')) \
-        .values('date') \
-        .annotate(count=Count('id', distinct=True), sum=Sum('expensepart__amount')) \
-        .order_by('date') \
-        .all()
-
-    months = [months.filter(date__month=i) for i in range(1, 13)]
-
-    values = [
-        (0, 0) if m.count() == 0 else (m.get()['count'], float(m.get()['sum']))
-        for m in months
-    ]
-    return [list(v) for v in zip(*values)]
+    def compute():
+        counts = [0] * 12
+        sums = [0.0] * 12
+        months = ExpenseRollup.objects.filter(year=year).order_by().values('month') \
+            .annotate(count=Sum('expenses'), sum=Sum('amount'))
+        for month in months:
+            counts[month['month'] - 1] = month['count']
+            sums[month['month'] - 1] = float(month['sum'])
+        return [counts, sums]
+
+    timeout = None if year < datetime.now().year else settings.STATS_CACHE_TTL
+    return cache.get_or_set(monthly_key(year), compute, timeout)